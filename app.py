@@ -1,29 +1,52 @@
 
-import os, re, secrets, hashlib
+import os, re, secrets, hashlib, hmac, time
+import json
+import html
+import random
+import mimetypes
+import urllib.request
+from urllib.parse import quote
 import smtplib
 import ssl
+import threading
+import atexit
+import tempfile
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from types import MappingProxyType
+from functools import lru_cache, wraps
 from email.message import EmailMessage
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from datetime import datetime, date
-from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash, abort
-from sqlalchemy import func
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash, abort, make_response, g, has_request_context
+from sqlalchemy import func, insert, delete, select, update, bindparam, inspect, case, or_, event, create_engine
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.pool import NullPool
 from werkzeug.utils import secure_filename
-from markupsafe import escape
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
+from jinja2 import TemplateNotFound
 
 # Load environment variables from .env file
 load_dotenv()
 
 APP_VERSION = "3.6"
+# Only consulted by the development server at the bottom of this file
+DEBUG_MODE = os.environ.get("FLASK_ENV") != "production"
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 VIDEO_DIR = os.path.join(UPLOAD_DIR, "videos")
 THUMB_DIR = os.path.join(UPLOAD_DIR, "thumbnails")
 AVATAR_DIR = os.path.join(UPLOAD_DIR, "avatars")
+EMOJI_DIR = os.path.join(UPLOAD_DIR, "emojis")
+AD_DIR = os.path.join(UPLOAD_DIR, "ads")
 
 # Create upload directories if they don't exist
-for dir_path in [UPLOAD_DIR, VIDEO_DIR, THUMB_DIR, AVATAR_DIR, os.path.join(UPLOAD_DIR, "emojis")]:
+for dir_path in [UPLOAD_DIR, VIDEO_DIR, THUMB_DIR, AVATAR_DIR, EMOJI_DIR, AD_DIR]:
     os.makedirs(dir_path, exist_ok=True)
 
 app = Flask(__name__)
@@ -36,32 +59,307 @@ if database_url.startswith("postgres://"):
     database_url = database_url.replace("postgres://", "postgresql://", 1)
 app.config["SQLALCHEMY_DATABASE_URI"] = database_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+if not database_url.startswith("sqlite"):
+    # Size the pool per worker process; pre_ping/recycle drop connections the server has closed
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", "10")),
+        "pool_pre_ping": os.environ.get("DB_PRE_PING", "1") != "0",
+        "pool_recycle": 1800,
+    }
 app.config["MAX_CONTENT_LENGTH"] = 512 * 1024 * 1024  # 512MB
 
+# JSON responses: orjson when installed (several times faster for the polling endpoints)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    from flask.json.provider import DefaultJSONProvider
+
+    class ORJSONProvider(DefaultJSONProvider):
+        # Dates still go through Flask's default hook so the output format doesn't change
+        OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        def dumps(self, obj, **kwargs):
+            option = self.OPTIONS | (orjson.OPT_INDENT_2 if kwargs.get("indent") else 0)
+            return orjson.dumps(obj, default=self.default, option=option).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = ORJSONProvider(app)
+
 # use the centralized models/db module
 from models import (
     db, User, Server, Channel, Membership, Video, Message, Sponsor, Activity,
     Playlist, PlaylistVideo, Subscription, VideoLike, WatchLater, Short,
-    Notification, VoiceParticipant, Friendship, DirectMessage, hash_pw, safe_slug, EmailVerification,
+    Notification, VoiceParticipant, Friendship, DirectMessage, hash_pw, check_pw, needs_rehash, safe_slug, EmailVerification,
     RtcSignal, RtcParticipant, VideoComment, CustomEmoji, Post, Role, RoleMembership, Advertisement,
-    MusicBot, MusicQueue
+    MusicBot, MusicQueue, TRGM_INDEXES
 )
 
 # initialize db with the app
 db.init_app(app)
+
+# When duplicates block a new unique index, the oldest row of each group is kept;
+# for voice participation the latest join wins
+UNIQUE_INDEX_KEEP = {"uq_voiceparticipant_user": func.max}
+
+def _ensure_unique_indexes() -> set:
+    """Create the unique indexes the models declare but an older database lacks.
+
+    create_all() only builds indexes along with brand-new tables, and insert_ignore()
+    and upsert() rely on these to detect collisions. Rows that would violate an index
+    are deleted first. Returns the names of the unique indexes now in place.
+    """
+    insp = inspect(db.engine)
+    present = set()
+    for table in db.metadata.sorted_tables:
+        wanted = [ix for ix in table.indexes if ix.unique]
+        if not wanted:
+            continue
+        existing = {ix["name"] for ix in insp.get_indexes(table.name)}
+        for ix in wanted:
+            if ix.name not in existing:
+                cols = list(ix.columns)
+                # NULLs never collide in a unique index, so rows with one are left alone
+                not_null = [c.isnot(None) for c in cols]
+                keep_fn = UNIQUE_INDEX_KEEP.get(ix.name, func.min)
+                # Wrapped in a derived table: MySQL won't select from the table it deletes from
+                keep = select(keep_fn(table.c.id)).where(*not_null).group_by(*cols).subquery()
+                try:
+                    with db.engine.begin() as conn:
+                        removed = conn.execute(
+                            delete(table).where(*not_null, table.c.id.not_in(select(keep.c[0])))).rowcount
+                        ix.create(conn)
+                    print(f"[db] Created unique index {ix.name} ({removed} duplicate rows removed)")
+                except Exception as e:
+                    print(f"[db] Could not create unique index {ix.name}: {e}")
+                    continue
+            present.add(ix.name)
+    return present
+
+def _ensure_trgm_indexes():
+    """Build the PostgreSQL trigram search indexes, if pg_trgm is available.
+
+    Kept apart from create_all(): a role that can't create the extension only loses the
+    search indexes (search falls back to a scan) instead of failing table creation.
+    """
+    if db.engine.dialect.name != "postgresql":
+        return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception as e:
+        print(f"[db] pg_trgm unavailable, search runs without trigram indexes: {e}")
+        return
+    for name, (table, column) in TRGM_INDEXES.items():
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" USING gin ({column} gin_trgm_ops)'))
+        except Exception as e:
+            print(f"[db] Could not create index {name}: {e}")
+
+def _create_tables():
+    # Ensure new tables (like EmailVerification) exist after code updates
+    try:
+        db.create_all()
+        app.config["_UNIQUE_INDEXES"] = _ensure_unique_indexes()
+        app.config["_TABLES_READY"] = True
+    except Exception as e:
+        print(f"[db] Could not create tables: {e}")
+        return
+    _ensure_trgm_indexes()
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Workers booting together (no gunicorn preload, several mod_wsgi processes) take turns on a
+# file lock; the first runs create_all and leaves a marker the others trust for this long
+SCHEMA_READY_WINDOW = 30
+
+def _create_tables_once():
+    # SQLite's create_all is a local file check, not worth coordinating
+    if fcntl is None or database_url.startswith("sqlite"):
+        _create_tables()
+        return
+    # Keyed by database and model set so a release that adds tables never trusts an old marker
+    tag = hashlib.sha1("|".join([database_url, *sorted(db.metadata.tables)]).encode()).hexdigest()[:12]
+    base = os.path.join(tempfile.gettempdir(), f"cannaspot-schema-{tag}")
+    with open(base + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file closes
+        try:
+            if time.time() - os.stat(base + ".ready").st_mtime < SCHEMA_READY_WINDOW:
+                app.config["_TABLES_READY"] = True
+                return
+        except FileNotFoundError:
+            pass
+        _create_tables()
+        if app.config.get("_TABLES_READY"):
+            open(base + ".ready", "w").close()
+
+# Deployments that create the schema once per release (`flask --app app db-init`) can set
+# SKIP_DB_INIT=1 so every worker doesn't repeat create_all's schema queries at boot
+if os.environ.get("SKIP_DB_INIT") == "1":
+    app.config["_TABLES_READY"] = True
+else:
+    with app.app_context():
+        _create_tables_once()
+
+@app.cli.command("db-init")
+def db_init_command():
+    """Create missing tables and indexes."""
+    db.create_all()
+    _ensure_unique_indexes()
+    _ensure_trgm_indexes()
+    print("✅ Database tables created/verified")
+
+def _db_cascades_user_delete():
+    """True when the database itself removes a deleted user's rows (ON DELETE CASCADE in effect).
+
+    SQLite only enforces foreign keys with PRAGMA foreign_keys=ON, and tables created
+    before the constraints were declared don't carry them, so check the live schema.
+    """
+    if "_USER_FK_CASCADE" not in app.config:
+        cascades = False
+        if db.engine.dialect.name != "sqlite":
+            try:
+                fks = inspect(db.engine).get_foreign_keys("video")
+                cascades = any(fk["constrained_columns"] == ["uploader_id"]
+                               and (fk.get("options") or {}).get("ondelete", "").upper() == "CASCADE"
+                               for fk in fks)
+            except Exception as e:
+                print(f"[db] Could not inspect foreign keys: {e}")
+        app.config["_USER_FK_CASCADE"] = cascades
+    return app.config["_USER_FK_CASCADE"]
+
+def _unique_index_in_place(ix) -> bool:
+    """Whether the live database has unique index `ix` (checked once per process)."""
+    if "_UNIQUE_INDEXES" not in app.config:
+        # Boot skipped schema setup (SKIP_DB_INIT, or another worker just ran it): look, don't build
+        insp = inspect(db.engine)
+        app.config["_UNIQUE_INDEXES"] = {
+            found["name"]
+            for table in db.metadata.sorted_tables if any(i.unique for i in table.indexes)
+            for found in insp.get_indexes(table.name)
+        }
+    return ix.name in app.config["_UNIQUE_INDEXES"]
+
+def insert_ignore(model, **values) -> bool:
+    """INSERT a row unless it collides with a unique index, in one statement.
+
+    Returns True when the row was inserted. Uses ON CONFLICT DO NOTHING on
+    SQLite/PostgreSQL and INSERT IGNORE on MySQL. If the database is missing the
+    model's unique index, falls back to looking for the row first.
+    """
+    table = model.__table__
+    ix = next((i for i in table.indexes if i.unique), None)
+    if ix is not None and not _unique_index_in_place(ix):
+        if any(values.get(col.name) is None for col in ix.columns):
+            # NULLs never collide in a unique index
+            db.session.execute(insert(model).values(**values))
+            return True
+        match = [col == values[col.name] for col in ix.columns]
+        if db.session.execute(select(table.c.id).where(*match).limit(1)).first():
+            return False
+        db.session.execute(insert(model).values(**values))
+        return True
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model).values(**values).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model).values(**values).on_conflict_do_nothing()
+    elif dialect in ("mysql", "mariadb"):
+        stmt = insert(model).values(**values).prefix_with("IGNORE")
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(model).values(**values))
+            return True
+        except IntegrityError:
+            return False
+    return db.session.execute(stmt).rowcount > 0
+
+def upsert(model, key: str, **values):
+    """INSERT a row, or update the existing row with the same unique `key`, in one statement.
+
+    If the database is missing the unique index on `key`, ON CONFLICT has nothing to
+    match, so the existing row is deleted and the new one inserted instead.
+    """
+    changes = {k: v for k, v in values.items() if k != key}
+    ix = next((i for i in model.__table__.indexes if i.unique and [c.name for c in i.columns] == [key]), None)
+    dialect = db.session.get_bind().dialect.name
+    if ix is not None and not _unique_index_in_place(ix):
+        db.session.execute(delete(model).where(getattr(model, key) == values[key]))
+        stmt = insert(model).values(**values)
+    elif dialect in ("postgresql", "sqlite"):
+        ins = postgresql.insert(model) if dialect == "postgresql" else sqlite.insert(model)
+        stmt = ins.values(**values).on_conflict_do_update(index_elements=[key], set_=changes)
+    elif dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(model).values(**values).on_duplicate_key_update(**changes)
+    else:
+        db.session.execute(delete(model).where(getattr(model, key) == values[key]))
+        stmt = insert(model).values(**values)
+    db.session.execute(stmt)
+
+class SessionUser(namedtuple("SessionUser", "id username is_admin")):
+    """Identity stored in the signed session cookie.
+
+    Covers what most routes and templates need; any other attribute falls
+    through to the full User row, loaded on first use.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        row = current_user_row()
+        if row is None:
+            raise AttributeError(name)
+        return getattr(row, name)
+
+def login_user(u: User):
+    session["uid"] = u.id
+    session["uname"] = u.username
+    session["admin"] = bool(u.is_admin)
+
 def current_user():
+    # Built from the session, no query; cached on g for the request
+    if "user" in g:
+        return g.user
     uid = session.get("uid")
-    if not uid:
-        return None
-    return User.query.get(uid)
+    if uid and "uname" not in session:
+        # Session from before identity was stored in the cookie
+        row = current_user_row()
+        if row:
+            login_user(row)
+    g.user = SessionUser(uid, session["uname"], session["admin"]) if uid and "uname" in session else None
+    return g.user
+
+def current_user_row():
+    """The logged-in User row, for handlers that mutate it or need a fresh is_admin."""
+    if "user_row" in g:
+        return g.user_row
+    uid = session.get("uid")
+    g.user_row = db.session.get(User, uid) if uid else None
+    if uid and g.user_row is None:
+        # The account was deleted: drop the stale cookie and carry on logged out
+        session.clear()
+        g.user = None
+    return g.user_row
+
+def acting_user():
+    """current_user() for page views; the checked User row when the request writes (POST)."""
+    return current_user_row() if request.method == "POST" else current_user()
 
 @app.before_request
 def ensure_tables():
-    # Lightweight safeguard to ensure new tables (like EmailVerification) exist after code updates
-    try:
-        db.create_all()
-    except Exception:
-        pass
+    # Only does work if the create_all at boot failed (e.g. database was unreachable)
+    if not app.config.get("_TABLES_READY"):
+        _create_tables()
 
 # --- Email configuration helpers ---
 SMTP_HOST = os.environ.get("SMTP_HOST")
@@ -72,16 +370,107 @@ SMTP_FROM = os.environ.get("SMTP_FROM", os.environ.get("SMTP_USER", "no-reply@ca
 SMTP_USE_SSL = os.environ.get("SMTP_USE_SSL", "false").lower() in ("1", "true", "yes")
 SMTP_USE_TLS = os.environ.get("SMTP_USE_TLS", "true").lower() in ("1", "true", "yes")
 
-def send_email(subject: str, to: str, text_body: str, html_body: str | None = None) -> bool:
-    """Send an email using SMTP settings from environment.
+# --- Redis and background jobs ---
+# With REDIS_URL set (and celery/redis installed) SMTP work and periodic flushes run on
+# a worker:  celery -A app.celery_app worker -B -Q email_queue,celery
+REDIS_URL = os.environ.get("REDIS_URL")
+try:
+    from celery import Celery
+except ImportError:
+    # celery not installed, emails are sent inline
+    Celery = None
+try:
+    import redis
+except ImportError:
+    redis = None
+
+redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=1) if redis and REDIS_URL else None
+
+celery_app = None
+if Celery and REDIS_URL:
+    celery_app = Celery("cannaspot", broker=REDIS_URL)
+    celery_app.conf.update(
+        task_routes={"cannaspot.send_email": {"queue": "email_queue"}},
+        # Fail fast when the broker is down so send_email can fall back to inline SMTP
+        task_publish_retry=False,
+        beat_schedule={
+            "flush-view-counts": {"task": "cannaspot.flush_view_counts", "schedule": 30.0},
+            "flush-notifications": {"task": "cannaspot.flush_notifications", "schedule": 2.0},
+            "flush-last-seen": {"task": "cannaspot.flush_last_seen", "schedule": 300.0},
+        },
+    )
+
+class SmtpConnectionPool:
+    """Per-thread cache of logged-in SMTP connections.
 
-    Returns True on success, False otherwise. If SMTP not configured, logs and returns False.
+    Reusing a connection skips the TCP connect, TLS negotiation and AUTH for every
+    message after the first one on a thread (request thread or Celery worker).
+    Connections are health-checked with RSET before reuse and retired after
+    MAX_MESSAGES sends.
     """
-    if not SMTP_HOST or not to:
-        # SMTP not configured; avoid breaking the flow in dev
-        print(f"[email] SMTP not configured or no recipient. Skipping send to {to} with subject '{subject}'.")
-        return False
+    MAX_MESSAGES = 10000
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _conns(self) -> dict:
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        return conns
+
+    @staticmethod
+    def _open():
+        if SMTP_USE_SSL:
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+            if SMTP_USE_TLS:
+                server.starttls(context=ssl.create_default_context())
+        if SMTP_USER and SMTP_PASS:
+            server.login(SMTP_USER, SMTP_PASS)
+        return server
+
+    @staticmethod
+    def _healthy(server) -> bool:
+        try:
+            # RSET also clears any half-finished transaction from a failed send
+            return server.rset()[0] == 250
+        except Exception:
+            return False
+
+    def _discard(self, key):
+        entry = self._conns().pop(key, None)
+        if entry:
+            try:
+                entry[0].quit()
+            except Exception:
+                entry[0].close()
+
+    @contextmanager
+    def connection(self):
+        key = (SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_USE_SSL)
+        conns = self._conns()
+        entry = conns.get(key)  # [server, messages_sent]
+        if entry and (entry[1] >= self.MAX_MESSAGES or not self._healthy(entry[0])):
+            self._discard(key)
+            entry = None
+        if entry is None:
+            entry = conns[key] = [self._open(), 0]
+        try:
+            yield entry[0]
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # Server answered, the connection itself is still usable
+            raise
+        except Exception:
+            self._discard(key)
+            raise
+        entry[1] += 1
+
+smtp_pool = SmtpConnectionPool()
 
+def _deliver_email(subject: str, to: str, text_body: str, html_body: str | None = None) -> None:
+    """Build and send a single message over a pooled SMTP connection. Raises on SMTP errors."""
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = SMTP_FROM
@@ -91,36 +480,86 @@ def send_email(subject: str, to: str, text_body: str, html_body: str | None = No
         msg.add_alternative(html_body, subtype="html")
 
     try:
-        if SMTP_USE_SSL:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
-                if SMTP_USER and SMTP_PASS:
-                    server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                if SMTP_USE_TLS:
-                    server.starttls(context=ssl.create_default_context())
-                if SMTP_USER and SMTP_PASS:
-                    server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        print(f"[email] Sent to {to}: {subject}")
+        with smtp_pool.connection() as server:
+            server.send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # Idle connection was dropped by the server; redial once
+        with smtp_pool.connection() as server:
+            server.send_message(msg)
+    print(f"[email] Sent to {to}: {subject}")
+
+if celery_app:
+    @celery_app.task(name="cannaspot.send_email", bind=True, max_retries=5)
+    def send_email_task(self, subject, to, text_body, html_body=None):
+        try:
+            _deliver_email(subject, to, text_body, html_body)
+        except Exception as e:
+            print(f"[email] Failed to send to {to} (attempt {self.request.retries + 1}): {e}")
+            # Exponential backoff: 30s, 60s, 120s, ... capped at 10 minutes
+            raise self.retry(exc=e, countdown=min(30 * 2 ** self.request.retries, 600))
+
+def send_email(subject: str, to: str, text_body: str, html_body: str | None = None) -> bool:
+    """Send an email using SMTP settings from environment.
+
+    Queues the message on the Celery email worker when a broker is configured,
+    otherwise (or if the broker is unreachable) sends inline.
+    Returns True on success/queued, False otherwise. If SMTP not configured, logs and returns False.
+    """
+    if not SMTP_HOST or not to:
+        # SMTP not configured; avoid breaking the flow in dev
+        print(f"[email] SMTP not configured or no recipient. Skipping send to {to} with subject '{subject}'.")
+        return False
+
+    if celery_app:
+        try:
+            send_email_task.delay(subject, to, text_body, html_body)
+            return True
+        except Exception as e:
+            print(f"[email] Queue unavailable, sending inline: {e}")
+
+    try:
+        _deliver_email(subject, to, text_body, html_body)
         return True
     except Exception as e:
         print(f"[email] Failed to send to {to}: {e}")
         return False
 
-def send_welcome_email(user: User):
-    """Compose and send the welcome email to a new user."""
-    try:
-        site_url = request.host_url.rstrip('/')
-        text_body = render_template("email/welcome.txt", user=user, site_url=site_url)
-        html_body = None
+# Email templates are resolved once at import; the HTML part of each is optional
+def _load_email_templates() -> dict:
+    templates = {}
+    for name in ("welcome", "welcome_verify", "verify_email", "reset_password"):
+        text_tpl = app.jinja_env.get_template(f"email/{name}.txt")
+        try:
+            html_tpl = app.jinja_env.get_template(f"email/{name}.html")
+        except TemplateNotFound:
+            html_tpl = None
+        templates[name] = (text_tpl, html_tpl)
+    return templates
+
+_EMAIL_TEMPLATES = _load_email_templates()
+
+def render_email(name: str, **context) -> tuple[str, str | None]:
+    """Render the (text, html) bodies of a cached email template."""
+    text_tpl, html_tpl = _EMAIL_TEMPLATES[name]
+    context.setdefault("datetime", datetime)
+    text_body = text_tpl.render(**context)
+    html_body = None
+    if html_tpl is not None:
         try:
-            html_body = render_template("email/welcome.html", user=user, site_url=site_url)
+            html_body = html_tpl.render(**context)
         except Exception:
             # HTML template optional
             html_body = None
+    return text_body, html_body
+
+def send_welcome_email(user: User):
+    """Compose and send the welcome email to a new user."""
+    if not SMTP_HOST:
+        print(f"[email] SMTP not configured, skipping welcome email to {user.email}")
+        return
+    try:
+        site_url = request.host_url.rstrip('/')
+        text_body, html_body = render_email("welcome", user=user, site_url=site_url)
         send_email(
             subject="Welcome to CannaSpot 🌿",
             to=user.email,
@@ -152,18 +591,16 @@ def verify_token(token: str, purpose: str, max_age: int) -> User | None:
         return None
     if data.get("purpose") != purpose:
         return None
-    return User.query.get(data.get("uid"))
+    return db.session.get(User, data.get("uid"))
 
 def send_verification_email(user: User):
+    if not SMTP_HOST:
+        print(f"[email] SMTP not configured, skipping verification email to {user.email}")
+        return
     token = generate_token(user, "verify")
     link = url_for("verify_email", token=token, _external=True)
     site_url = request.host_url.rstrip('/')
-    text_body = render_template("email/verify_email.txt", user=user, verify_link=link, site_url=site_url)
-    html_body = None
-    try:
-        html_body = render_template("email/verify_email.html", user=user, verify_link=link, site_url=site_url)
-    except Exception:
-        pass
+    text_body, html_body = render_email("verify_email", user=user, verify_link=link, site_url=site_url)
     send_email(
         subject="Verify your CannaSpot email",
         to=user.email,
@@ -171,16 +608,34 @@ def send_verification_email(user: User):
         html_body=html_body
     )
 
+def send_welcome_and_verify(user: User):
+    """Signup email: welcome blurb plus verification link in a single message."""
+    if not SMTP_HOST:
+        print(f"[email] SMTP not configured, skipping welcome email to {user.email}")
+        return
+    try:
+        token = generate_token(user, "verify")
+        link = url_for("verify_email", token=token, _external=True)
+        site_url = request.host_url.rstrip('/')
+        text_body, html_body = render_email("welcome_verify", user=user, verify_link=link, site_url=site_url)
+        send_email(
+            subject="Welcome to CannaSpot 🌿 Please verify your email",
+            to=user.email,
+            text_body=text_body,
+            html_body=html_body,
+        )
+    except Exception as e:
+        # Never block signup on email failure
+        print(f"[email] Welcome email error: {e}")
+
 def send_password_reset_email(user: User):
+    if not SMTP_HOST:
+        print(f"[email] SMTP not configured, skipping password reset email to {user.email}")
+        return
     token = generate_token(user, "reset")
     link = url_for("reset_password", token=token, _external=True)
     site_url = request.host_url.rstrip('/')
-    text_body = render_template("email/reset_password.txt", user=user, reset_link=link, site_url=site_url)
-    html_body = None
-    try:
-        html_body = render_template("email/reset_password.html", user=user, reset_link=link, site_url=site_url)
-    except Exception:
-        pass
+    text_body, html_body = render_email("reset_password", user=user, reset_link=link, site_url=site_url)
     send_email(
         subject="Reset your CannaSpot password",
         to=user.email,
@@ -189,6 +644,28 @@ def send_password_reset_email(user: User):
     )
 
 # Template filters
+@lru_cache(maxsize=1024)
+def _parse_iso(value: str) -> datetime | None:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def _format_str_date(value: str, fmt: str) -> str:
+    dt = _parse_iso(value)
+    return dt.strftime(fmt) if dt else value
+
+def _format_epoch(value, fmt: str) -> str:
+    return datetime.fromtimestamp(value).strftime(fmt)
+
+_DATE_DISPATCH = {
+    datetime: lambda value, fmt: value.strftime(fmt),
+    date: lambda value, fmt: value.strftime(fmt),
+    int: _format_epoch,
+    float: _format_epoch,
+    str: _format_str_date,
+}
+
 @app.template_filter("date")
 def jinja_date(value, fmt: str = "%b %d, %Y"):
     """Format dates safely in templates.
@@ -198,22 +675,14 @@ def jinja_date(value, fmt: str = "%b %d, %Y"):
     """
     if value is None:
         return ""
-    try:
-        if isinstance(value, (int, float)):
-            dt = datetime.fromtimestamp(value)
-        elif isinstance(value, str):
-            # Try ISO 8601 first
-            try:
-                dt = datetime.fromisoformat(value)
-            except Exception:
-                return value
-        elif isinstance(value, datetime):
-            dt = value
-        elif isinstance(value, date):
-            return value.strftime(fmt)
-        else:
+    fn = _DATE_DISPATCH.get(type(value))
+    if fn is None:
+        # Subclasses (e.g. Markup) fall back to their nearest supported base type
+        fn = next((_DATE_DISPATCH[t] for t in type(value).__mro__ if t in _DATE_DISPATCH), None)
+        if fn is None:
             return str(value)
-        return dt.strftime(fmt)
+    try:
+        return fn(value, fmt)
     except Exception:
         return str(value)
 
@@ -290,6 +759,7 @@ def install():
         app.config["SECRET_KEY"] = secret
         app.config["SQLALCHEMY_DATABASE_URI"] = url
         db.engine.dispose()
+        app.config.pop("_USER_FK_CASCADE", None)
         db.drop_all()
         db.create_all()
         username = request.form["admin_user"].strip()
@@ -321,6 +791,7 @@ def install():
         db.session.add_all([Membership(user_id=admin.id, server_id=srv.id), Membership(user_id=bot.id, server_id=srv.id)])
         db.session.add(Sponsor(name="Top420Seeds.com", url="https://top420seeds.com", logo="/static/logo.png", active=True))
         db.session.commit()
+        clear_globals_cache()
         
         # Try to send welcome email to admin if SMTP is configured
         if smtp_host:
@@ -341,9 +812,13 @@ from sqlalchemy import func
 def login():
     if request.method == "POST":
         u = User.query.filter(func.lower(User.username)==request.form["username"].lower()).first()
-        import hashlib
-        if u and u.password_hash == hashlib.sha256(request.form["password"].encode("utf-8")).hexdigest():
-            session["uid"] = u.id
+        password = request.form["password"]
+        if u and check_pw(u.password_hash, password):
+            if needs_rehash(u.password_hash):
+                # Upgrade legacy SHA-256 (or outdated argon2) hashes on successful login
+                u.password_hash = hash_pw(password)
+                db.session.commit()
+            login_user(u)
             return redirect(url_for("recent"))
     return render_template("login.html")
 
@@ -359,14 +834,13 @@ def register():
                 display=request.form.get("display") or request.form["username"],
                 password_hash=hash_pw(request.form["password"])
             )
-            db.session.add(u); db.session.commit()
-            # Fire-and-forget welcome email
-            try:
-                send_welcome_email(u)
-                send_verification_email(u)
-            except Exception as _e:
-                print(f"[email] Skipping welcome email: {_e}")
-            session["uid"] = u.id
+            db.session.add(u); db.session.flush()
+            # Pending verification row goes in with the user; verify_email fills verified_at
+            db.session.add(EmailVerification(user_id=u.id))
+            db.session.commit()
+            # Fire-and-forget welcome + verification email
+            send_welcome_and_verify(u)
+            login_user(u)
             return redirect(url_for("recent"))
     return render_template("register.html")
 
@@ -386,6 +860,22 @@ def verify_email(token):
     flash("Email verified. Welcome!", "success")
     return redirect(url_for("recent"))
 
+@app.route("/resend-verification", methods=["POST"])
+def resend_verification():
+    u = current_user_row()
+    if not u:
+        return redirect(url_for("login"))
+    ev = EmailVerification.query.filter_by(user_id=u.id).first()
+    if ev and ev.verified_at:
+        flash("Your email is already verified", "info")
+    else:
+        try:
+            send_verification_email(u)
+        except Exception as e:
+            print(f"[email] verification resend failed: {e}")
+        flash("Verification email sent. Check your inbox.", "info")
+    return redirect(request.referrer or url_for("recent"))
+
 @app.route("/forgot-password", methods=["GET","POST"])
 def forgot_password():
     if request.method == "POST":
@@ -422,15 +912,57 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
+def conditional_json(view):
+    """ETag polling responses by their body; a matching If-None-Match gets an empty 304."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        resp = make_response(view(*args, **kwargs))
+        if resp.status_code == 200 and resp.is_json:
+            resp.add_etag()
+            # Per-user data: browsers may keep it but must revalidate each poll
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            resp.make_conditional(request)
+        return resp
+    return wrapper
+
+def _home_state():
+    """(etag, last_modified) for the home page.
+
+    New videos and likes move the MAX probes; deleted videos and likes (admin delete,
+    account deletion) move the COUNTs. All four are answered from indexes. Sponsors,
+    servers and ads are covered by the fill times of the cached rows the page renders
+    (inject_globals), and the ad-token window so a revalidated page never carries
+    expired click tokens.
+    """
+    latest, last_video, videos, last_like, likes = db.session.query(
+        select(func.max(Video.created_at)).scalar_subquery(),
+        select(func.max(Video.id)).scalar_subquery(),
+        select(func.count(Video.id)).scalar_subquery(),
+        select(func.max(VideoLike.id)).scalar_subquery(),
+        select(func.count(VideoLike.id)).scalar_subquery(),
+    ).one()
+    ad_bucket = int(time.time() // AD_TOKEN_WINDOW)
+    raw = (f"{APP_VERSION}:{session.get('uid')}:{latest}:{last_video}:{videos}:{last_like}:{likes}"
+           f":{ad_bucket}:{globals_stamp()}")
+    return hashlib.md5(raw.encode("utf-8")).hexdigest(), latest
+
 @app.route("/")
 def recent():
     try:
         # Check if database is initialized
-        user_count = User.query.count()
-        if user_count == 0:
+        if not db.session.query(User.id).first():
             # No users, redirect to install
             return redirect(url_for("install"))
         
+        # Repeat visits skip the queries and render below when nothing changed
+        etag, latest = _home_state()
+        conditional = not session.get("_flashes")
+        if conditional and request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            return resp
+        
         # Get GrowBot user ID (YouTube videos uploader)
         bot = User.query.filter_by(username="GrowBot").first()
         bot_id = bot.id if bot else None
@@ -444,26 +976,218 @@ def recent():
         # Combine: uploaded first, then YouTube
         vids = uploaded_vids + youtube_vids
         
-        # Add like counts to each video
+        # Add like counts to each video (one GROUP BY instead of a COUNT per video)
+        like_counts = {}
+        if vids:
+            like_counts = dict(db.session.query(VideoLike.video_id, func.count(VideoLike.id))
+                               .filter(VideoLike.video_id.in_([v.id for v in vids]))
+                               .group_by(VideoLike.video_id).all())
         for v in vids:
-            v.like_count = VideoLike.query.filter_by(video_id=v.id).count()
+            v.like_count = like_counts.get(v.id, 0)
         
         servers = Server.query.order_by(Server.name).all()
-        return render_template("recent.html", videos=vids, uploaded=uploaded_vids, youtube=youtube_vids, servers=servers, user=current_user())
+        resp = make_response(render_template("recent.html", videos=vids, uploaded=uploaded_vids, youtube=youtube_vids, servers=servers, user=current_user()))
+        if conditional:
+            resp.set_etag(etag)
+            if latest:
+                resp.last_modified = latest
+            # Per-user page: browsers may keep it but must revalidate
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+        return resp
     except Exception as e:
         # Database not initialized, redirect to install
         print(f"Error loading home page: {e}")
         return redirect(url_for("install"))
 
+COMMENTS_PER_PAGE = 50
+VIEW_KEY = "vc:{}"
+
+def record_view(video_id: int):
+    """Count a video view. Buffered in Redis when a Celery worker runs flush_view_counts."""
+    if redis_client and celery_app:
+        try:
+            redis_client.incr(VIEW_KEY.format(video_id))
+            return
+        except Exception as e:
+            print(f"[views] Redis unavailable, writing directly: {e}")
+    db.session.execute(update(Video).where(Video.id == video_id)
+                       .values(view_count=func.coalesce(Video.view_count, 0) + 1))
+    db.session.commit()
+
+def pending_views(video_id: int) -> int:
+    """Views recorded in Redis but not yet flushed to the database."""
+    if not (redis_client and celery_app):
+        return 0
+    try:
+        return int(redis_client.get(VIEW_KEY.format(video_id)) or 0)
+    except Exception:
+        return 0
+
+def flush_view_counts() -> int:
+    """Move buffered view counts from Redis into video.view_count. Returns videos updated."""
+    if not redis_client:
+        return 0
+    rows = []
+    for key in redis_client.scan_iter(VIEW_KEY.format("*"), count=500):
+        # GET + DEL in one MULTI so increments landing mid-flush are kept for the next run
+        pipe = redis_client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        n, _ = pipe.execute()
+        if n and int(n):
+            rows.append({"vid": int(key.decode().split(":", 1)[1]), "n": int(n)})
+    if rows:
+        videos = Video.__table__
+        db.session.execute(update(videos).where(videos.c.id == bindparam("vid"))
+                           .values(view_count=func.coalesce(videos.c.view_count, 0) + bindparam("n")), rows)
+        db.session.commit()
+    return len(rows)
+
+NOTIF_UNREAD_KEY = "notif:unread:{}"
+MSG_UNREAD_KEY = "msg:unread:{}"
+UNREAD_TTL = 600
+# Per-process copy in front of Redis/COUNT; several open tabs polling collapse into one lookup
+UNREAD_LOCAL_TTL = 10
+_unread_cache = {}  # key -> (count, expires_at)
+
+def _unread_lookup(key: str, count_query) -> int:
+    if not redis_client:
+        return count_query()
+    try:
+        with redis_client.pipeline() as pipe:
+            # Writers bump the :gen key (forget_unread); if one lands while we count, the
+            # transaction below is dropped instead of caching a count that predates it
+            pipe.watch(key + ":gen")
+            cached = pipe.get(key)
+            if cached is not None:
+                return int(cached)
+            count = count_query()
+            pipe.multi()
+            pipe.set(key, count, ex=UNREAD_TTL)
+            try:
+                pipe.execute()
+            except redis.WatchError:
+                pass
+            return count
+    except redis.RedisError as e:
+        print(f"[unread] Redis unavailable, counting in the database: {e}")
+        return count_query()
+
+def unread_count(key_fmt: str, user_id: int, count_query) -> int:
+    """Unread counter for a user. Served from Redis when cached, else count_query() seeds it."""
+    key = key_fmt.format(user_id)
+    now = time.monotonic()
+    hit = _unread_cache.get(key)
+    if hit and hit[1] > now:
+        return hit[0]
+    # Exceptions propagate before the store, so a failed lookup is never cached
+    count = _unread_lookup(key, count_query)
+    _unread_cache[key] = (count, now + UNREAD_LOCAL_TTL)
+    return count
+
+def forget_unread(key_fmt: str, *user_ids):
+    """Drop cached unread counters after their rows changed. Call after the commit.
+
+    The next read recounts from the database; bumping the :gen key also stops a read
+    that was already counting from caching its older result.
+    """
+    for uid in user_ids:
+        _unread_cache.pop(key_fmt.format(uid), None)
+    if redis_client and user_ids:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for uid in user_ids:
+                key = key_fmt.format(uid)
+                pipe.delete(key)
+                pipe.incr(key + ":gen")
+                pipe.expire(key + ":gen", UNREAD_TTL)
+            pipe.execute()
+        except Exception as e:
+            print(f"[unread] Could not clear counters: {e}")
+
+NOTIF_QUEUE_KEY = "notif:queue"
+NOTIF_FLUSH_MAX = 500
+
+def add_notification(user_id: int, message: str, link: str | None = None):
+    """Notify a user. Call before the request's commit.
+
+    With Redis and a Celery worker the notification is queued and written in batches by
+    flush_notifications, so the request doesn't pay for the INSERT. Otherwise (or if Redis
+    is unreachable) it is added to the session and goes in with the caller's commit.
+    """
+    if redis_client and celery_app:
+        try:
+            redis_client.rpush(NOTIF_QUEUE_KEY, json.dumps({
+                "user_id": user_id, "message": message, "link": link,
+                "created_at": datetime.utcnow().isoformat()}))
+            return
+        except Exception as e:
+            print(f"[notify] Redis unavailable, writing directly: {e}")
+    db.session.add(Notification(user_id=user_id, message=message, link=link))
+    db.session.info.setdefault("notified", []).append(user_id)
+
+@event.listens_for(db.session, "after_commit")
+def _bump_notified(session):
+    # Unread counters only move once the notification rows are actually committed
+    notified = session.info.pop("notified", ())
+    if notified:
+        forget_unread(NOTIF_UNREAD_KEY, *set(notified))
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _drop_notified(session, previous_transaction):
+    session.info.pop("notified", None)
+
+def flush_notifications() -> int:
+    """Write up to NOTIF_FLUSH_MAX queued notifications with one executemany. Returns rows written."""
+    if not redis_client:
+        return 0
+    # LRANGE + LTRIM in one MULTI so notifications queued mid-flush stay for the next run
+    pipe = redis_client.pipeline()
+    pipe.lrange(NOTIF_QUEUE_KEY, 0, NOTIF_FLUSH_MAX - 1)
+    pipe.ltrim(NOTIF_QUEUE_KEY, NOTIF_FLUSH_MAX, -1)
+    raw, _ = pipe.execute()
+    if not raw:
+        return 0
+    rows = [json.loads(r) for r in raw]
+    try:
+        # Skip users deleted since their notification was queued
+        live = set(db.session.scalars(select(User.id).where(User.id.in_({r["user_id"] for r in rows}))))
+        rows = [dict(r, created_at=datetime.fromisoformat(r["created_at"])) for r in rows if r["user_id"] in live]
+        if rows:
+            db.session.execute(insert(Notification.__table__), rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # Put the batch back at the head of the queue, in order
+        redis_client.lpush(NOTIF_QUEUE_KEY, *reversed(raw))
+        print(f"[notify] Flush failed, {len(raw)} notifications re-queued: {e}")
+        return 0
+    forget_unread(NOTIF_UNREAD_KEY, *{r["user_id"] for r in rows})
+    return len(rows)
+
+if celery_app:
+    @celery_app.task(name="cannaspot.flush_view_counts")
+    def flush_view_counts_task():
+        with app.app_context():
+            return flush_view_counts()
+
+    @celery_app.task(name="cannaspot.flush_notifications")
+    def flush_notifications_task():
+        with app.app_context():
+            total = 0
+            while (n := flush_notifications()) == NOTIF_FLUSH_MAX:
+                total += n
+            return total + n
+
 @app.route("/watch/<int:vid>", methods=["GET", "POST"])
 def watch(vid):
     v = Video.query.get_or_404(vid)
-    u = current_user()
+    u = acting_user()
     
     # Increment view count (only on GET, not on comment POST)
     if request.method == "GET":
-        v.view_count = (v.view_count or 0) + 1
-        db.session.commit()
+        record_view(vid)
     
     # Handle comment submission
     if request.method == "POST" and u:
@@ -471,35 +1195,67 @@ def watch(vid):
         if content:
             comment = VideoComment(video_id=vid, user_id=u.id, content=content)
             db.session.add(comment)
-            db.session.commit()
             # Notify uploader
             if v.uploader_id and v.uploader_id != u.id:
-                notif = Notification(
-                    user_id=v.uploader_id,
-                    message=f"{u.username} commented on your video: {v.title[:30]}",
-                    link=url_for("watch", vid=vid)
-                )
-                db.session.add(notif)
-                db.session.commit()
+                add_notification(v.uploader_id, f"{u.username} commented on your video: {v.title[:30]}",
+                                 url_for("watch", vid=vid))
+            db.session.commit()
         return redirect(url_for("watch", vid=vid))
     
-    # Get comments with user info
-    comments_data = (db.session.query(VideoComment, User)
-                    .join(User, User.id == VideoComment.user_id)
-                    .filter(VideoComment.video_id == vid)
-                    .order_by(VideoComment.created_at.desc())
-                    .all())
-    
-    comments = [{"author": user.username, "text": comment.content, "created_at": comment.created_at} 
-                for comment, user in comments_data]
+    # Get the newest comments with their authors loaded in the same query
+    comments = (VideoComment.query
+                .options(joinedload(VideoComment.user))
+                .filter_by(video_id=vid)
+                .order_by(VideoComment.created_at.desc())
+                .limit(COMMENTS_PER_PAGE)
+                .all())
+    comment_count = len(comments)
+    if comment_count == COMMENTS_PER_PAGE:
+        comment_count = VideoComment.query.filter_by(video_id=vid).count()
     
     more = Video.query.order_by(Video.created_at.desc()).limit(10).all()
-    return render_template("watch.html", video=v, related=more, comments=comments, user=u)
+    views = (v.view_count or 0) + pending_views(vid)
+    return render_template("watch.html", video=v, views=views, related=more, comments=comments, comment_count=comment_count, user=u)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+def hashed_upload_name(digest: str, filename: str) -> str:
+    """Default write_upload naming: content-hash prefix, so identical uploads share a name."""
+    return f"{digest[:16]}_{filename}"
+
+def random_upload_name(prefix: str = "", nbytes: int = 8):
+    """write_upload naming with a random hex prefix, for files that are never shared."""
+    return lambda digest, filename: f"{prefix}{secrets.token_hex(nbytes)}_{filename}"
+
+def write_upload(storage, dest_dir: str, name=hashed_upload_name) -> str:
+    """Stream an upload into dest_dir in 1MB chunks (FileStorage.save uses 16KB), hashing it in the same pass.
+
+    The file is written under a temporary name, then renamed to name(sha256 hex, secure filename),
+    so readers never see a partial file and uploads sharing a filename never overwrite each
+    other. Returns the stored filename.
+    """
+    fname = secure_filename(storage.filename) or "upload"
+    tmp_path = os.path.join(dest_dir, f".{secrets.token_hex(8)}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = storage.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        stored = name(digest.hexdigest(), fname)
+        os.replace(tmp_path, os.path.join(dest_dir, stored))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return stored
 
-from werkzeug.utils import secure_filename
 @app.route("/upload", methods=["GET","POST"])
 def upload():
-    u = current_user()
+    u = acting_user()
     if not u: return redirect(url_for("login"))
     if request.method == "POST":
         f = request.files.get("video")
@@ -507,17 +1263,10 @@ def upload():
         title = request.form.get("title","Untitled")
         desc = request.form.get("description","")
         if f:
-            fname = secure_filename(f.filename)
-            path = os.path.join("uploads","videos", fname)
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            f.save(path)
+            fname = write_upload(f, VIDEO_DIR)
             thumb_rel = None
             if t:
-                tname = secure_filename(t.filename)
-                tpath = os.path.join("uploads","thumbnails", tname)
-                os.makedirs(os.path.dirname(tpath), exist_ok=True)
-                t.save(tpath)
-                thumb_rel = "/uploads/thumbnails/" + tname
+                thumb_rel = "/uploads/thumbnails/" + write_upload(t, THUMB_DIR)
             v = Video(title=title, filename="/uploads/videos/"+fname, thumbnail=thumb_rel, description=desc, uploader_id=u.id)
             db.session.add(v); db.session.commit()
             return redirect(url_for("recent"))
@@ -525,7 +1274,7 @@ def upload():
 
 @app.route("/upload-short", methods=["GET","POST"])
 def upload_short():
-    u = current_user()
+    u = acting_user()
     if not u: 
         return redirect(url_for("login"))
     if request.method == "POST":
@@ -533,18 +1282,11 @@ def upload_short():
         t = request.files.get("thumb")
         title = request.form.get("title","Untitled Short")
         if f:
-            fname = secure_filename(f.filename)
-            path = os.path.join("uploads","videos", fname)
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            f.save(path)
+            fname = write_upload(f, VIDEO_DIR)
             
             thumb_rel = None
             if t:
-                tname = secure_filename(t.filename)
-                tpath = os.path.join("uploads","thumbnails", tname)
-                os.makedirs(os.path.dirname(tpath), exist_ok=True)
-                t.save(tpath)
-                thumb_rel = "/uploads/thumbnails/" + tname
+                thumb_rel = "/uploads/thumbnails/" + write_upload(t, THUMB_DIR)
             
             short = Short(title=title, filename="/uploads/videos/"+fname, thumbnail=thumb_rel, uploader_id=u.id)
             db.session.add(short)
@@ -564,7 +1306,7 @@ def server(slug):
     ch = Channel.query.filter_by(server_id=s.id).all()
     mem = Membership.query.filter_by(server_id=s.id).count()
     ismem = False
-    u = current_user()
+    u = acting_user()
     if u:
         ismem = bool(Membership.query.filter_by(user_id=u.id, server_id=s.id).first())
         # Handle join request
@@ -580,7 +1322,7 @@ def server(slug):
 def channel(slug, cid):
     s = Server.query.filter_by(slug=slug).first_or_404()
     ch = Channel.query.get_or_404(cid)
-    u = current_user()
+    u = acting_user()
     channels = Channel.query.filter_by(server_id=s.id).all()
     if request.method == "POST" and u:
         content = request.form.get("content","").strip()[:2000]
@@ -595,7 +1337,7 @@ def channel(slug, cid):
 
 @app.route("/create-server", methods=["GET","POST"])
 def create_server():
-    u = current_user()
+    u = acting_user()
     if not u: return redirect(url_for("login"))
     if request.method == "POST":
         name = request.form["name"]
@@ -604,20 +1346,18 @@ def create_server():
         icon_path = None
         
         if icon_file and icon_file.filename:
-            fname = secure_filename(icon_file.filename)
-            icon_path = os.path.join("uploads", "avatars", f"server_{secrets.token_hex(4)}_{fname}")
-            os.makedirs(os.path.dirname(icon_path), exist_ok=True)
-            icon_file.save(icon_path)
-            icon_path = "/" + icon_path.replace("\\", "/")
+            fname = write_upload(icon_file, AVATAR_DIR, random_upload_name("server_", 4))
+            icon_path = "/uploads/avatars/" + fname
         
         s = Server(name=name, slug=slug, owner_id=u.id, server_icon=icon_path)
-        db.session.add(s); db.session.commit()
+        db.session.add(s); db.session.flush()
         # Create default text channel
         db.session.add(Channel(server_id=s.id, name="general", is_voice=False))
         # Create default voice channel
         db.session.add(Channel(server_id=s.id, name="Voice Chat", is_voice=True))
+        db.session.add(Membership(user_id=u.id, server_id=s.id))
         db.session.commit()
-        db.session.add(Membership(user_id=u.id, server_id=s.id)); db.session.commit()
+        clear_globals_cache()
         return redirect(url_for("server", slug=slug))
     return render_template("create_server.html", user=u)
 
@@ -696,9 +1436,24 @@ SETUP_TEMPLATES = {
     }
 }
 
+# Freeze the templates so every request shares the same read-only structures
+SETUP_TEMPLATES = MappingProxyType({
+    key: {"name": tmpl["name"], "roles": tuple(tmpl["roles"]), "channels": tuple(tmpl["channels"])}
+    for key, tmpl in SETUP_TEMPLATES.items()
+})
+
+# Flattened channel rows per template, positions already assigned; setup_bot only adds server_id
+SETUP_CHANNEL_ROWS = MappingProxyType({
+    key: tuple(
+        {"name": ch["name"], "is_voice": ch["is_voice"], "category": cat["category"], "position": pos}
+        for pos, (cat, ch) in enumerate((cat, ch) for cat in tmpl["channels"] for ch in cat["channels"])
+    )
+    for key, tmpl in SETUP_TEMPLATES.items()
+})
+
 @app.route("/server/<slug>/setup-bot", methods=["GET", "POST"])
 def setup_bot(slug):
-    u = current_user()
+    u = acting_user()
     if not u: return redirect(url_for("login"))
     
     s = Server.query.filter_by(slug=slug).first_or_404()
@@ -708,63 +1463,55 @@ def setup_bot(slug):
     
     if request.method == "POST":
         template_key = request.form.get("template", "general")
-        template = SETUP_TEMPLATES.get(template_key, SETUP_TEMPLATES["general"])
+        if template_key not in SETUP_TEMPLATES:
+            template_key = "general"
+        template = SETUP_TEMPLATES[template_key]
         
-        # Clear existing channels and roles (except owner)
-        Channel.query.filter_by(server_id=s.id).delete()
-        Role.query.filter_by(server_id=s.id).delete()
-        db.session.commit()
+        # Replace existing channels and roles using bulk statements in a single transaction
+        db.session.execute(delete(Channel).where(Channel.server_id == s.id))
+        db.session.execute(delete(Role).where(Role.server_id == s.id))
         
         # Create roles
-        created_roles = {}
-        for role_data in template["roles"]:
-            role = Role(
-                server_id=s.id,
-                name=role_data["name"],
-                color=role_data["color"],
-                position=role_data["position"],
-                is_admin=role_data.get("is_admin", False),
-                can_manage_channels=role_data.get("can_manage_channels", False),
-                can_manage_roles=role_data.get("can_manage_roles", False),
-                can_kick_members=role_data.get("can_kick_members", False),
-                can_ban_members=role_data.get("can_ban_members", False),
-                can_send_messages=role_data.get("can_send_messages", True),
-                can_manage_messages=role_data.get("can_manage_messages", False),
-                can_mention_everyone=role_data.get("can_mention_everyone", False)
-            )
-            db.session.add(role)
-            db.session.flush()
-            created_roles[role_data["name"]] = role
+        role_rows = [{
+            "server_id": s.id,
+            "name": role_data["name"],
+            "color": role_data["color"],
+            "position": role_data["position"],
+            "is_admin": role_data.get("is_admin", False),
+            "can_manage_channels": role_data.get("can_manage_channels", False),
+            "can_manage_roles": role_data.get("can_manage_roles", False),
+            "can_kick_members": role_data.get("can_kick_members", False),
+            "can_ban_members": role_data.get("can_ban_members", False),
+            "can_send_messages": role_data.get("can_send_messages", True),
+            "can_manage_messages": role_data.get("can_manage_messages", False),
+            "can_mention_everyone": role_data.get("can_mention_everyone", False),
+        } for role_data in template["roles"]]
         
-        # Assign owner to Admin role
-        if "Admin" in created_roles:
-            db.session.add(RoleMembership(user_id=u.id, role_id=created_roles["Admin"].id))
+        # Assign owner to Admin role. Where executemany supports RETURNING (SQLite, PostgreSQL)
+        # the insert hands back the new ids; MySQL has no RETURNING, so look the role up instead
+        if db.session.get_bind().dialect.insert_executemany_returning:
+            created_roles = db.session.execute(insert(Role).returning(Role.id, Role.name), role_rows).all()
+            admin_role_id = next((rid for rid, name in created_roles if name == "Admin"), None)
+        else:
+            db.session.execute(insert(Role), role_rows)
+            admin_role_id = db.session.query(Role.id).filter_by(server_id=s.id, name="Admin").scalar()
+        if admin_role_id:
+            db.session.add(RoleMembership(user_id=u.id, role_id=admin_role_id))
         
         # Create channels with categories
-        position = 0
-        for cat_group in template["channels"]:
-            category = cat_group["category"]
-            for ch_data in cat_group["channels"]:
-                channel = Channel(
-                    server_id=s.id,
-                    name=ch_data["name"],
-                    is_voice=ch_data["is_voice"],
-                    category=category,
-                    position=position
-                )
-                db.session.add(channel)
-                position += 1
+        channel_rows = SETUP_CHANNEL_ROWS[template_key]
+        db.session.execute(insert(Channel), [dict(row, server_id=s.id) for row in channel_rows])
         
         db.session.commit()
         
-        flash(f"✅ Server setup complete! Created {len(template['roles'])} roles and {sum(len(c['channels']) for c in template['channels'])} channels", "success")
+        flash(f"✅ Server setup complete! Created {len(template['roles'])} roles and {len(channel_rows)} channels", "success")
         return redirect(url_for("server", slug=slug))
     
     return render_template("setup_bot.html", user=u, server=s, templates=SETUP_TEMPLATES)
 
 @app.route("/profile", methods=["GET","POST"])
 def my_profile():
-    u = current_user()
+    u = current_user_row()
     if not u: return redirect(url_for("login"))
     if request.method == "POST":
         u.display = request.form.get("display") or u.display
@@ -776,7 +1523,7 @@ def my_profile():
 
 @app.route("/change-password", methods=["POST"])
 def change_password():
-    u = current_user()
+    u = current_user_row()
     if not u: return redirect(url_for("login"))
     
     current_pw = request.form.get("current_password", "")
@@ -784,7 +1531,7 @@ def change_password():
     confirm_pw = request.form.get("confirm_password", "")
     
     # Verify current password
-    if u.password_hash != hash_pw(current_pw):
+    if not check_pw(u.password_hash, current_pw):
         flash("❌ Current password is incorrect", "error")
         return redirect(url_for("my_profile"))
     
@@ -803,9 +1550,11 @@ def change_password():
     flash("✅ Password changed successfully!", "success")
     return redirect(url_for("my_profile"))
 
+ADMIN_PER_PAGE = 25
+
 @app.route("/theGspot", methods=["GET","POST"])
 def admin_panel():
-    u = current_user()
+    u = current_user_row()
     if not (u and u.is_admin): abort(403)
     if request.method == "POST":
         action = request.form.get("action")
@@ -813,70 +1562,94 @@ def admin_panel():
         # User management
         if action == "make_admin":
             uid = int(request.form.get("user_id"))
-            x = User.query.get(uid); 
+            x = db.session.get(User, uid); 
             if x: 
                 x.is_admin = True; db.session.commit()
                 flash(f"✅ {x.username} is now an admin", "success")
         
         elif action == "remove_admin":
             uid = int(request.form.get("user_id"))
-            x = User.query.get(uid)
+            x = db.session.get(User, uid)
             if x and x.id != u.id:  # Can't demote yourself
                 x.is_admin = False; db.session.commit()
                 flash(f"✅ Removed admin from {x.username}", "success")
         
         elif action == "delete_user":
             uid = int(request.form.get("user_id"))
-            x = User.query.get(uid)
+            x = db.session.get(User, uid)
             if x and x.id != u.id:  # Can't delete yourself
-                # Delete user's content
-                Video.query.filter_by(uploader_id=uid).delete()
-                Message.query.filter_by(user_id=uid).delete()
-                DirectMessage.query.filter(
-                    (DirectMessage.sender_id == uid) | (DirectMessage.recipient_id == uid)
-                ).delete()
-                Friendship.query.filter(
-                    (Friendship.user_id == uid) | (Friendship.friend_id == uid)
-                ).delete()
-                Notification.query.filter_by(user_id=uid).delete()
-                Membership.query.filter_by(user_id=uid).delete()
-                db.session.delete(x)
-                db.session.commit()
-                flash(f"🗑️ Deleted user {x.username} and all their content", "warning")
+                # One transaction, no autoflush between the bulk deletes; all or nothing
+                try:
+                    # Their unread DMs vanish from other users' counters
+                    dm_recipients = db.session.scalars(
+                        select(DirectMessage.recipient_id).distinct()
+                        .where(DirectMessage.sender_id == uid, DirectMessage.is_read == False)).all()
+                    with db.session.no_autoflush:
+                        if not _db_cascades_user_delete():
+                            # Delete user's content (otherwise ON DELETE CASCADE does it with the user row)
+                            Video.query.filter_by(uploader_id=uid).delete(synchronize_session=False)
+                            Message.query.filter_by(user_id=uid).delete(synchronize_session=False)
+                            DirectMessage.query.filter(
+                                (DirectMessage.sender_id == uid) | (DirectMessage.recipient_id == uid)
+                            ).delete(synchronize_session=False)
+                            Friendship.query.filter(
+                                (Friendship.user_id == uid) | (Friendship.friend_id == uid)
+                            ).delete(synchronize_session=False)
+                            Notification.query.filter_by(user_id=uid).delete(synchronize_session=False)
+                            Membership.query.filter_by(user_id=uid).delete(synchronize_session=False)
+                        db.session.delete(x)
+                    db.session.commit()
+                    forget_unread(MSG_UNREAD_KEY, *dm_recipients)
+                    flash(f"🗑️ Deleted user {x.username} and all their content", "warning")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"[admin] delete_user {uid} rolled back: {e}")
+                    flash("❌ Could not delete user, nothing was changed", "error")
         
         # Video management
         elif action == "delete_video":
             vid = int(request.form.get("video_id"))
-            v = Video.query.get(vid)
+            v = db.session.get(Video, vid)
             if v:
                 # Delete related records
                 VideoLike.query.filter_by(video_id=vid).delete()
                 WatchLater.query.filter_by(video_id=vid).delete()
                 PlaylistVideo.query.filter_by(video_id=vid).delete()
-                # Try to delete actual file
-                if v.filename and os.path.exists(v.filename.lstrip('/')):
+                stored = v.filename
+                db.session.delete(v)
+                db.session.commit()
+                # Remove the file only once the rows are gone. Identical uploads share one
+                # content-hashed file, so keep it while another video or short points at it
+                in_use = stored and (db.session.query(Video.id).filter_by(filename=stored).first()
+                                     or db.session.query(Short.id).filter_by(filename=stored).first())
+                path = os.path.join(BASE_DIR, stored.lstrip('/')) if stored else None
+                if path and not in_use and os.path.exists(path):
                     try:
-                        os.remove(v.filename.lstrip('/'))
+                        os.remove(path)
                     except:
                         pass
-                db.session.delete(v)
-                db.session.commit()
                 flash(f"🗑️ Deleted video: {v.title}", "warning")
         
         # Server management
         elif action == "delete_server":
             sid = int(request.form.get("server_id"))
-            s = Server.query.get(sid)
+            s = db.session.get(Server, sid)
             if s:
-                # Delete channels and messages
-                for ch in Channel.query.filter_by(server_id=sid).all():
-                    Message.query.filter_by(channel_id=ch.id).delete()
-                    VoiceParticipant.query.filter_by(channel_id=ch.id).delete()
-                Channel.query.filter_by(server_id=sid).delete()
-                Membership.query.filter_by(server_id=sid).delete()
-                db.session.delete(s)
-                db.session.commit()
-                flash(f"🗑️ Deleted server: {s.name}", "warning")
+                try:
+                    with db.session.no_autoflush:
+                        # Delete channels and messages (one statement per table, not per channel)
+                        server_channels = select(Channel.id).where(Channel.server_id == sid)
+                        Message.query.filter(Message.channel_id.in_(server_channels)).delete(synchronize_session=False)
+                        VoiceParticipant.query.filter(VoiceParticipant.channel_id.in_(server_channels)).delete(synchronize_session=False)
+                        Channel.query.filter_by(server_id=sid).delete(synchronize_session=False)
+                        Membership.query.filter_by(server_id=sid).delete(synchronize_session=False)
+                        db.session.delete(s)
+                    db.session.commit()
+                    flash(f"🗑️ Deleted server: {s.name}", "warning")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"[admin] delete_server {sid} rolled back: {e}")
+                    flash("❌ Could not delete server, nothing was changed", "error")
         
         # Sponsor management
         elif action == "add_sponsor":
@@ -887,7 +1660,7 @@ def admin_panel():
         
         elif action == "toggle_sponsor":
             sid = int(request.form.get("sponsor_id"))
-            s = Sponsor.query.get(sid)
+            s = db.session.get(Sponsor, sid)
             if s:
                 s.active = not s.active
                 db.session.commit()
@@ -895,7 +1668,7 @@ def admin_panel():
         
         elif action == "delete_sponsor":
             sid = int(request.form.get("sponsor_id"))
-            s = Sponsor.query.get(sid)
+            s = db.session.get(Sponsor, sid)
             if s:
                 db.session.delete(s)
                 db.session.commit()
@@ -912,30 +1685,15 @@ def admin_panel():
             if 'emoji_image' in request.files:
                 file = request.files['emoji_image']
                 if file and file.filename:
-                    fname = secure_filename(file.filename)
-                    # Create emojis directory if it doesn't exist
-                    emoji_dir = os.path.join(UPLOAD_DIR, 'emojis')
-                    os.makedirs(emoji_dir, exist_ok=True)
                     # Save with unique name
-                    unique_fname = f"{secrets.token_hex(8)}_{fname}"
+                    unique_fname = write_upload(file, EMOJI_DIR, random_upload_name())
                     image_path = os.path.join('emojis', unique_fname)
-                    file.save(os.path.join(UPLOAD_DIR, image_path))
             
             # Need either emoji_char or image
             if emoji_char or image_path:
-                # Check for duplicates
-                if emoji_char:
-                    existing = CustomEmoji.query.filter_by(emoji_char=emoji_char, category=category).first()
-                else:
-                    existing = None
-                
-                if not existing:
-                    db.session.add(CustomEmoji(
-                        category=category, 
-                        emoji_char=emoji_char or None,
-                        image_path=image_path,
-                        label=label
-                    ))
+                # uq_emoji_cat rejects duplicates; no lookup first
+                if insert_ignore(CustomEmoji, category=category, emoji_char=emoji_char or None,
+                                 image_path=image_path, label=label):
                     db.session.commit()
                     flash(f"✅ Added emoji to {category}", "success")
                 else:
@@ -945,7 +1703,7 @@ def admin_panel():
         
         elif action == "delete_emoji":
             eid = int(request.form.get("emoji_id"))
-            e = CustomEmoji.query.get(eid)
+            e = db.session.get(CustomEmoji, eid)
             if e:
                 db.session.delete(e)
                 db.session.commit()
@@ -953,7 +1711,7 @@ def admin_panel():
         
         elif action == "toggle_emoji":
             eid = int(request.form.get("emoji_id"))
-            e = CustomEmoji.query.get(eid)
+            e = db.session.get(CustomEmoji, eid)
             if e:
                 e.is_active = not e.is_active
                 db.session.commit()
@@ -962,7 +1720,7 @@ def admin_panel():
         # Message moderation
         elif action == "delete_message":
             mid = int(request.form.get("message_id"))
-            m = Message.query.get(mid)
+            m = db.session.get(Message, mid)
             if m:
                 db.session.delete(m)
                 db.session.commit()
@@ -971,34 +1729,42 @@ def admin_panel():
         elif action == "transfer_server":
             sid = int(request.form.get("server_id"))
             new_owner_id = int(request.form.get("new_owner_id"))
-            s = Server.query.get(sid)
+            s = db.session.get(Server, sid)
             if s:
                 s.owner_id = new_owner_id
                 db.session.commit()
                 flash(f"✅ Server ownership transferred to user #{new_owner_id}", "success")
         
+        clear_globals_cache()
         return redirect(url_for("admin_panel"))
     
     # Get data for display
-    stats = {
-        "users": User.query.count(),
-        "videos": Video.query.count(),
-        "messages": Message.query.count(),
-        "servers": Server.query.count(),
-        "channels": Channel.query.count(),
-        "sponsors": Sponsor.query.count(),
-        "admins": User.query.filter_by(is_admin=True).count(),
-        "custom_emojis": CustomEmoji.query.filter_by(is_active=True).count(),
-        "ads": Advertisement.query.count(),
-        "active_ads": Advertisement.query.filter_by(is_active=True).count(),
+    # All dashboard counts as scalar subqueries of one SELECT (one round trip)
+    stat_queries = {
+        "users": select(func.count(User.id)),
+        "videos": select(func.count(Video.id)),
+        "messages": select(func.count(Message.id)),
+        "servers": select(func.count(Server.id)),
+        "channels": select(func.count(Channel.id)),
+        "sponsors": select(func.count(Sponsor.id)),
+        "admins": select(func.count(User.id)).where(User.is_admin == True),
+        "custom_emojis": select(func.count(CustomEmoji.id)).where(CustomEmoji.is_active == True),
+        "ads": select(func.count(Advertisement.id)),
+        "active_ads": select(func.count(Advertisement.id)).where(Advertisement.is_active == True),
     }
+    stats = dict(db.session.execute(
+        select(*(q.scalar_subquery().label(name) for name, q in stat_queries.items()))
+    ).mappings().one())
     
     users = User.query.order_by(User.created_at.desc()).limit(50).all()
     videos = Video.query.order_by(Video.created_at.desc()).limit(50).all()
-    servers = Server.query.order_by(Server.created_at.desc()).all()
-    sponsors = Sponsor.query.all()
-    custom_emojis = CustomEmoji.query.order_by(CustomEmoji.category, CustomEmoji.sort_order).all()
-    advertisements = Advertisement.query.order_by(Advertisement.created_at.desc()).all()
+    # Each list pages independently (?servers_page=, ?sponsors_page=, ...)
+    def page_of(query, arg):
+        return query.paginate(page=request.args.get(arg, 1, type=int), per_page=ADMIN_PER_PAGE, error_out=False)
+    servers_page = page_of(Server.query.order_by(Server.created_at.desc()), "servers_page")
+    sponsors_page = page_of(Sponsor.query.order_by(Sponsor.id), "sponsors_page")
+    emojis_page = page_of(CustomEmoji.query.order_by(CustomEmoji.category, CustomEmoji.sort_order, CustomEmoji.id), "emojis_page")
+    ads_page = page_of(Advertisement.query.order_by(Advertisement.created_at.desc()), "ads_page")
     recent_messages = (db.session.query(Message, User, Server, Channel)
                       .join(User, User.id == Message.user_id)
                       .join(Server, Server.id == Message.server_id)
@@ -1006,14 +1772,15 @@ def admin_panel():
                       .order_by(Message.created_at.desc())
                       .limit(100).all())
     
-    return render_template("admin.html", user=u, sponsors=sponsors, stats=stats, 
-                         users=users, videos=videos, servers=servers, 
-                         recent_messages=recent_messages, custom_emojis=custom_emojis,
-                         advertisements=advertisements)
+    return render_template("admin.html", user=u, sponsors=sponsors_page.items, stats=stats, 
+                         users=users, videos=videos, servers=servers_page.items, 
+                         recent_messages=recent_messages, custom_emojis=emojis_page.items,
+                         advertisements=ads_page.items, servers_page=servers_page,
+                         sponsors_page=sponsors_page, emojis_page=emojis_page, ads_page=ads_page)
 
 @app.route("/admin/ad/create", methods=["POST"])
 def admin_create_ad():
-    u = current_user()
+    u = current_user_row()
     if not u or not u.is_admin:
         return redirect(url_for("login"))
     
@@ -1026,11 +1793,8 @@ def admin_create_ad():
     image_path = None
     ad_image = request.files.get("image")
     if ad_image and ad_image.filename:
-        fname = secure_filename(ad_image.filename)
-        image_path = os.path.join("uploads", "ads", f"ad_{secrets.token_hex(4)}_{fname}")
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        ad_image.save(image_path)
-        image_path = "/" + image_path.replace("\\", "/")
+        fname = write_upload(ad_image, AD_DIR, random_upload_name("ad_", 4))
+        image_path = "/uploads/ads/" + fname
     
     ad = Advertisement(
         title=title,
@@ -1042,79 +1806,216 @@ def admin_create_ad():
     )
     db.session.add(ad)
     db.session.commit()
+    clear_globals_cache()
     flash("✅ Advertisement created!", "success")
     return redirect(url_for("admin_panel"))
 
 @app.route("/admin/ad/<int:ad_id>/toggle", methods=["POST"])
 def admin_toggle_ad(ad_id):
-    u = current_user()
+    u = current_user_row()
     if not u or not u.is_admin:
         return {"error": "Unauthorized"}, 403
     
     ad = Advertisement.query.get_or_404(ad_id)
     ad.is_active = not ad.is_active
     db.session.commit()
+    clear_globals_cache()
     return {"success": True, "is_active": ad.is_active}
 
 @app.route("/admin/ad/<int:ad_id>/delete", methods=["POST"])
 def admin_delete_ad(ad_id):
-    u = current_user()
+    u = current_user_row()
     if not u or not u.is_admin:
         return redirect(url_for("login"))
     
     ad = Advertisement.query.get_or_404(ad_id)
     db.session.delete(ad)
     db.session.commit()
+    clear_globals_cache()
     flash("🗑️ Advertisement deleted", "warning")
     return redirect(url_for("admin_panel"))
 
+AD_FLUSH_INTERVAL = float(os.environ.get("AD_FLUSH_INTERVAL", "10"))
+AD_FLUSH_MAX = 500  # flush early once this many hits are buffered
+
+class AdCounterBuffer:
+    """Per-process tally of ad views/clicks, written out as one batched UPDATE.
+
+    Every impression used to be its own read-modify-write transaction. Hits now
+    accumulate here and are flushed AD_FLUSH_INTERVAL seconds after the first one
+    (or sooner once AD_FLUSH_MAX pile up), and once more at interpreter exit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(lambda: [0, 0])
+        self._hits = 0
+        self._timer = None
+
+    def add(self, ad_id: int, views: int = 0, clicks: int = 0):
+        with self._lock:
+            counts = self._pending[ad_id]
+            counts[0] += views
+            counts[1] += clicks
+            self._hits += 1
+            full = self._hits >= AD_FLUSH_MAX
+            if not full and self._timer is None:
+                self._timer = threading.Timer(AD_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write buffered counts to the database. Returns ads updated."""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0, 0])
+            self._hits = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        rows = [{"aid": ad_id, "dv": v, "dc": c} for ad_id, (v, c) in pending.items()]
+        ads = Advertisement.__table__
+        try:
+            with app.app_context():
+                db.session.execute(update(ads).where(ads.c.id == bindparam("aid"))
+                                   .values(view_count=func.coalesce(ads.c.view_count, 0) + bindparam("dv"),
+                                           click_count=func.coalesce(ads.c.click_count, 0) + bindparam("dc")), rows)
+                db.session.commit()
+        except Exception as e:
+            print(f"[ads] Could not flush ad counters, keeping them for the next run: {e}")
+            with self._lock:
+                for row in rows:
+                    counts = self._pending[row["aid"]]
+                    counts[0] += row["dv"]
+                    counts[1] += row["dc"]
+            return 0
+        return len(rows)
+
+ad_counters = AdCounterBuffer()
+atexit.register(ad_counters.flush)
+
+# Ad pages carry a signed token so the counters only move for impressions we served.
+# Tokens rotate hourly; the current and previous hour are accepted.
+AD_TOKEN_WINDOW = 3600
+
+def _ad_token_for(ad_id: int, bucket: int) -> str:
+    key = app.config["SECRET_KEY"].encode("utf-8")
+    return hmac.new(key, f"ad:{ad_id}:{bucket}".encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+@app.template_global()
+def ad_token(ad_id: int) -> str:
+    return _ad_token_for(ad_id, int(time.time() // AD_TOKEN_WINDOW))
+
+def _ad_token_ok(ad_id: int) -> bool:
+    token = request.args.get("t", "")
+    bucket = int(time.time() // AD_TOKEN_WINDOW)
+    return any(hmac.compare_digest(token, _ad_token_for(ad_id, b)) for b in (bucket, bucket - 1))
+
 @app.route("/api/ad/<int:ad_id>/view", methods=["POST"])
 def ad_view(ad_id):
-    ad = Advertisement.query.get(ad_id)
-    if ad:
-        ad.view_count += 1
-        db.session.commit()
+    if not _ad_token_ok(ad_id):
+        return "", 204
+    ad_counters.add(ad_id, views=1)
     return {"success": True}
 
 @app.route("/api/ad/<int:ad_id>/click", methods=["POST"])
 def ad_click(ad_id):
-    ad = Advertisement.query.get(ad_id)
-    if ad:
-        ad.click_count += 1
-        db.session.commit()
+    if not _ad_token_ok(ad_id):
+        return "", 204
+    ad_counters.add(ad_id, clicks=1)
     return {"success": True}
 
+# Behind nginx, set UPLOADS_ACCEL_PREFIX (e.g. /_protected/) so nginx streams uploads
+# itself via X-Accel-Redirect instead of tying up a worker (see deploy/nginx_uploads.conf)
+UPLOADS_ACCEL_PREFIX = os.environ.get("UPLOADS_ACCEL_PREFIX")
+# Behind Apache mod_xsendfile or LiteSpeed, set UPLOADS_X_SENDFILE=true instead; Flask then
+# answers with an X-Sendfile header carrying the absolute path and an empty body
+app.config["USE_X_SENDFILE"] = os.environ.get("UPLOADS_X_SENDFILE", "false").lower() in ("1", "true", "yes")
+
 @app.route("/uploads/<path:filename>")
 def uploads(filename):
-    return send_from_directory("uploads", filename)
+    if UPLOADS_ACCEL_PREFIX:
+        if safe_join(UPLOAD_DIR, filename) is None:
+            abort(404)
+        resp = make_response("")
+        resp.headers["X-Accel-Redirect"] = UPLOADS_ACCEL_PREFIX.rstrip("/") + "/" + quote(filename)
+        resp.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return resp
+    return send_from_directory(UPLOAD_DIR, filename, conditional=True)
+
+# Sidebar data shown on every page changes rarely; keep it for a few seconds per process.
+# Plain rows (not ORM objects) so they can be shared across requests and threads.
+GLOBALS_TTL = int(os.environ.get("GLOBALS_TTL", "30"))
+_globals_cache = {}  # key -> (expires_at, rows)
+
+def _cached_rows(key, stmt):
+    hit = _globals_cache.get(key)
+    now = time.monotonic()
+    if hit and hit[0] > now:
+        return hit[1]
+    rows = db.session.execute(stmt).all()
+    _globals_cache[key] = (now + GLOBALS_TTL, rows)
+    return rows
+
+def globals_stamp():
+    """Fill times of the cached sidebar rows; changes whenever any of them is reloaded."""
+    inject_globals()
+    return ",".join(f"{k}={hit[0]}" for k, hit in sorted(_globals_cache.items()))
+
+def clear_globals_cache():
+    """Call after writes to sponsors, servers or ads so the next page shows them."""
+    _globals_cache.clear()
 
 @app.context_processor
 def inject_globals():
-    sponsors = Sponsor.query.filter_by(active=True).all()
-    servers = Server.query.order_by(Server.created_at.desc()).all()
+    sponsors = _cached_rows("sponsors", select(Sponsor.__table__).where(Sponsor.active == True))
+    servers = _cached_rows("servers", select(Server.__table__).order_by(Server.created_at.desc()))
     # Get active ads for different placements
-    sidebar_ads = Advertisement.query.filter_by(is_active=True, placement='sidebar').limit(3).all()
-    feed_ads = Advertisement.query.filter_by(is_active=True, placement='feed').limit(2).all()
+    sidebar_ads = _cached_rows("sidebar_ads", select(Advertisement.__table__).where(Advertisement.is_active == True, Advertisement.placement == 'sidebar').limit(3))
+    feed_ads = _cached_rows("feed_ads", select(Advertisement.__table__).where(Advertisement.is_active == True, Advertisement.placement == 'feed').limit(2))
     return dict(app_version="3.6", sponsors=sponsors, servers=servers, sidebar_ads=sidebar_ads, feed_ads=feed_ads)
 
 # ===================== WebRTC (Polling-based signaling for LiteSpeed) =====================
 from datetime import timedelta
 
+_ROOM_RE = re.compile(r"[^a-zA-Z0-9_-]")
+
+def clean_room(room: str) -> str:
+    """Light guard on room names used in URLs and signaling rows."""
+    return _ROOM_RE.sub("-", room)[:64]
+
 @app.route("/video/<room>")
 def video_room(room):
     u = current_user()
     if not u:
         return redirect(url_for("login"))
-    # Light guard on room name
-    room = re.sub(r"[^a-zA-Z0-9_-]", "-", room)[:64]
+    room = clean_room(room)
     return render_template("video_chat.html", room=room, user=u)
 
+# Housekeeping sweeps run at most this often per process instead of on every signal/poll
+RTC_SIGNAL_SWEEP_SECS = 300
+RTC_PRESENCE_SWEEP_SECS = 60
+_rtc_last_sweep = {}
+
+# Max signals returned per poll; clients pick up the rest from "latest" on the next poll
+RTC_POLL_LIMIT = 200
+
+def _sweep_due(name: str, interval: float) -> bool:
+    now = time.monotonic()
+    if now - _rtc_last_sweep.get(name, 0.0) < interval:
+        return False
+    _rtc_last_sweep[name] = now
+    return True
+
 @app.route("/api/rtc/join/<room>", methods=["POST"])
 def rtc_join(room):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    room = re.sub(r"[^a-zA-Z0-9_-]", "-", room)[:64]
+    room = clean_room(room)
     # Upsert participant
     part = RtcParticipant.query.filter_by(room=room, user_id=u.id).first()
     if not part:
@@ -1128,10 +2029,10 @@ def rtc_join(room):
 
 @app.route("/api/rtc/leave/<room>", methods=["POST"])
 def rtc_leave(room):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    room = re.sub(r"[^a-zA-Z0-9_-]", "-", room)[:64]
+    room = clean_room(room)
     RtcParticipant.query.filter_by(room=room, user_id=u.id).delete()
     # Optionally notify peers
     sig = RtcSignal(room=room, sender_id=u.id, target_id=None, kind="leave", payload="{}")
@@ -1141,10 +2042,10 @@ def rtc_leave(room):
 
 @app.route("/api/rtc/signal/<room>", methods=["POST"])
 def rtc_signal(room):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    room = re.sub(r"[^a-zA-Z0-9_-]", "-", room)[:64]
+    room = clean_room(room)
     data = request.get_json(force=True, silent=True) or {}
     target_id = data.get("target_id")
     kind = (data.get("kind") or "").strip()
@@ -1160,11 +2061,12 @@ def rtc_signal(room):
     if part:
         part.last_seen = datetime.utcnow()
     # Cleanup old signals (> 2 hours)
-    cutoff = datetime.utcnow() - timedelta(hours=2)
-    try:
-        RtcSignal.query.filter(RtcSignal.created_at < cutoff).delete()
-    except Exception:
-        pass
+    if _sweep_due("signals", RTC_SIGNAL_SWEEP_SECS):
+        cutoff = datetime.utcnow() - timedelta(hours=2)
+        try:
+            RtcSignal.query.filter(RtcSignal.created_at < cutoff).delete()
+        except Exception:
+            pass
     db.session.commit()
     return {"success": True, "id": sig.id}
 
@@ -1173,7 +2075,7 @@ def rtc_poll(room):
     u = current_user()
     if not u:
         return {"error": "Not logged in"}, 401
-    room = re.sub(r"[^a-zA-Z0-9_-]", "-", room)[:64]
+    room = clean_room(room)
     since = int(request.args.get("since", "0"))
     # Update presence
     part = RtcParticipant.query.filter_by(room=room, user_id=u.id).first()
@@ -1187,6 +2089,7 @@ def rtc_poll(room):
                        ((RtcSignal.target_id == u.id) | (RtcSignal.target_id.is_(None))),
                        (RtcSignal.sender_id != u.id))
                .order_by(RtcSignal.id.asc())
+               .limit(RTC_POLL_LIMIT)
                .all())
     out = [{
         "id": s.id,
@@ -1198,12 +2101,13 @@ def rtc_poll(room):
         "created_at": s.created_at.isoformat()
     } for s in signals]
     # Remove stale participants not seen for >5 minutes
-    cutoff = datetime.utcnow() - timedelta(minutes=5)
-    try:
-        RtcParticipant.query.filter(RtcParticipant.last_seen < cutoff).delete()
-        db.session.commit()
-    except Exception:
-        pass
+    if _sweep_due("participants", RTC_PRESENCE_SWEEP_SECS):
+        cutoff = datetime.utcnow() - timedelta(minutes=5)
+        try:
+            RtcParticipant.query.filter(RtcParticipant.last_seen < cutoff).delete()
+            db.session.commit()
+        except Exception:
+            pass
     return {"success": True, "signals": out, "latest": (out[-1]["id"] if out else since)}
 
 @app.route("/shorts")
@@ -1292,21 +2196,24 @@ def search():
     if not query:
         return redirect(url_for("recent"))
     
+    # Substring match; % and _ typed by the user are matched literally
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    
     # Search videos by title or description
     videos = Video.query.filter(
-        (Video.title.ilike(f"%{query}%")) | 
-        (Video.description.ilike(f"%{query}%"))
+        (Video.title.ilike(pattern, escape="\\")) | 
+        (Video.description.ilike(pattern, escape="\\"))
     ).order_by(Video.created_at.desc()).limit(50).all()
     
     # Search users by username or display name
     users = User.query.filter(
-        (User.username.ilike(f"%{query}%")) | 
-        (User.display.ilike(f"%{query}%"))
+        (User.username.ilike(pattern, escape="\\")) | 
+        (User.display.ilike(pattern, escape="\\"))
     ).limit(20).all()
     
     # Search servers by name
     servers = Server.query.filter(
-        Server.name.ilike(f"%{query}%")
+        Server.name.ilike(pattern, escape="\\")
     ).limit(20).all()
     
     return render_template("search.html", query=query, videos=videos, users=users, servers=servers, user=current_user())
@@ -1319,17 +2226,16 @@ def go_live():
     return render_template("go_live.html", user=u)
 
 # --- Posts helpers and routes ---
-import re as _re
+_URL_RE = re.compile(r"(https?://[\w\-._~:/?#\[\]@!$&'()*+,;=%]+)")
 
 def _render_post_html(text: str) -> str:
-    safe = escape(text or "")
-    url_re = _re.compile(r"(https?://[\w\-._~:/?#\[\]@!$&'()*+,;=%]+)")
-    safe = url_re.sub(r'<a href="\1" target="_blank" rel="nofollow noopener">\1</a>', str(safe))
+    safe = html.escape(text or "")
+    safe = _URL_RE.sub(r'<a href="\1" target="_blank" rel="nofollow noopener">\1</a>', safe)
     return safe.replace("\n", "<br>")
 
 @app.route("/create-post", methods=["GET","POST"])
 def create_post():
-    u = current_user()
+    u = acting_user()
     if not u:
         return redirect(url_for("login"))
     if request.method == "POST":
@@ -1344,14 +2250,22 @@ def create_post():
         return redirect(url_for("post_view", pid=p.id))
     return render_template("create_post.html", user=u)
 
+POSTS_PER_PAGE = 50
+
 @app.route("/posts")
 def posts():
     u = current_user()
-    rows = (db.session.query(Post, User)
-            .join(User, User.id == Post.user_id)
-            .order_by(Post.created_at.desc())
-            .all())
-    return render_template("posts.html", posts=rows, user=u)
+    # content_html is rendered at write time, so the list never needs content_raw
+    q = (Post.query
+         .options(load_only(Post.id, Post.user_id, Post.title, Post.content_html, Post.created_at, Post.updated_at),
+                  joinedload(Post.author).load_only(User.id, User.username, User.display, User.avatar))
+         .order_by(Post.id.desc()))
+    before = request.args.get("before", type=int)
+    if before:
+        q = q.filter(Post.id < before)
+    rows = q.limit(POSTS_PER_PAGE + 1).all()
+    next_before = rows[POSTS_PER_PAGE - 1].id if len(rows) > POSTS_PER_PAGE else None
+    return render_template("posts.html", posts=rows[:POSTS_PER_PAGE], next_before=next_before, user=u)
 
 @app.route("/post/<int:pid>")
 def post_view(pid):
@@ -1359,19 +2273,19 @@ def post_view(pid):
     p = db.session.get(Post, pid)
     if not p:
         abort(404)
-    author = User.query.get(p.user_id)
     can_edit = bool(u and (u.id == p.user_id or u.is_admin))
-    return render_template("post_view.html", post=p, author=author, can_edit=can_edit, user=u)
+    return render_template("post_view.html", post=p, author=p.author, can_edit=can_edit, user=u)
 
 @app.route("/post/<int:pid>/edit", methods=["GET","POST"])
 def post_edit(pid):
-    u = current_user()
+    u = acting_user()
     if not u:
         return redirect(url_for("login"))
     p = db.session.get(Post, pid)
     if not p:
         abort(404)
-    if not (u.id == p.user_id or u.is_admin):
+    # On GET u is the cookie identity, whose is_admin can be stale; admin rights come from the row
+    if not (u.id == p.user_id or getattr(current_user_row(), "is_admin", False)):
         abort(403)
     if request.method == "POST":
         title = (request.form.get("title") or "").strip()[:200]
@@ -1390,7 +2304,7 @@ def post_edit(pid):
 
 @app.route("/post/<int:pid>/delete", methods=["POST"])
 def post_delete(pid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return redirect(url_for("login"))
     p = db.session.get(Post, pid)
@@ -1428,7 +2342,7 @@ def voice_channel(slug, cid):
 
 @app.route("/playlist/create", methods=["GET", "POST"])
 def create_playlist():
-    u = current_user()
+    u = acting_user()
     if not u:
         return redirect(url_for("login"))
     if request.method == "POST":
@@ -1461,7 +2375,7 @@ def playlist_detail(pid):
 
 @app.route("/playlist/<int:pid>/edit", methods=["GET", "POST"])
 def edit_playlist(pid):
-    u = current_user()
+    u = acting_user()
     if not u:
         return redirect(url_for("login"))
     playlist = Playlist.query.get_or_404(pid)
@@ -1480,7 +2394,7 @@ def edit_playlist(pid):
 
 @app.route("/playlist/<int:pid>/delete", methods=["POST"])
 def delete_playlist(pid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return redirect(url_for("login"))
     playlist = Playlist.query.get_or_404(pid)
@@ -1498,31 +2412,27 @@ def api_playlists():
     u = current_user()
     if not u:
         return {"error": "Not logged in"}, 401
-    playlists = Playlist.query.filter_by(user_id=u.id).all()
+    playlists = db.session.execute(select(Playlist.id, Playlist.name).filter_by(user_id=u.id)).all()
     return {"success": True, "playlists": [{"id": p.id, "name": p.name} for p in playlists]}
 
 @app.route("/api/playlist/<int:pid>/add/<int:vid>", methods=["POST"])
 def api_add_to_playlist(pid, vid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
     playlist = Playlist.query.get_or_404(pid)
     if playlist.user_id != u.id:
         return {"error": "Unauthorized"}, 403
-    # Check if already in playlist
-    existing = PlaylistVideo.query.filter_by(playlist_id=pid, video_id=vid).first()
-    if existing:
-        return {"success": True, "message": "Already in playlist"}
     # Get max position
     max_pos = db.session.query(func.max(PlaylistVideo.position)).filter_by(playlist_id=pid).scalar() or 0
-    pv = PlaylistVideo(playlist_id=pid, video_id=vid, position=max_pos + 1)
-    db.session.add(pv)
+    if not insert_ignore(PlaylistVideo, playlist_id=pid, video_id=vid, position=max_pos + 1):
+        return {"success": True, "message": "Already in playlist"}
     db.session.commit()
     return {"success": True}
 
 @app.route("/api/playlist/<int:pid>/remove/<int:vid>", methods=["POST"])
 def api_remove_from_playlist(pid, vid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
     playlist = Playlist.query.get_or_404(pid)
@@ -1536,79 +2446,79 @@ def api_remove_from_playlist(pid, vid):
 
 @app.route("/api/like/<int:vid>", methods=["POST"])
 def like_video(vid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    if not VideoLike.query.filter_by(user_id=u.id, video_id=vid).first():
-        db.session.add(VideoLike(user_id=u.id, video_id=vid))
+    if insert_ignore(VideoLike, user_id=u.id, video_id=vid):
         # Notify uploader
-        video = Video.query.get(vid)
+        video = db.session.get(Video, vid)
         if video and video.uploader_id and video.uploader_id != u.id:
-            notif = Notification(user_id=video.uploader_id, message=f"{u.username} liked your video!")
-            db.session.add(notif)
+            add_notification(video.uploader_id, f"{u.username} liked your video!")
         db.session.commit()
     return {"success": True}
 
 @app.route("/api/watch-later/<int:vid>", methods=["POST"])
 def add_watch_later(vid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    if not WatchLater.query.filter_by(user_id=u.id, video_id=vid).first():
-        db.session.add(WatchLater(user_id=u.id, video_id=vid))
+    if insert_ignore(WatchLater, user_id=u.id, video_id=vid):
         db.session.commit()
     return {"success": True}
 
 @app.route("/api/subscribe/<int:uid>", methods=["POST"])
 def subscribe(uid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    if u.id != uid and not Subscription.query.filter_by(subscriber_id=u.id, subscribed_to_id=uid).first():
-        db.session.add(Subscription(subscriber_id=u.id, subscribed_to_id=uid))
+    if u.id != uid and insert_ignore(Subscription, subscriber_id=u.id, subscribed_to_id=uid):
         # Create notification for the subscribed user
-        target = User.query.get(uid)
+        target = db.session.get(User, uid)
         if target:
-            notif = Notification(user_id=uid, message=f"{u.username} subscribed to you!")
-            db.session.add(notif)
+            add_notification(uid, f"{u.username} subscribed to you!")
         db.session.commit()
     return {"success": True}
 
 @app.route("/api/notification/<int:nid>/read", methods=["POST"])
 def mark_notification_read(nid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    notif = Notification.query.get(nid)
-    if notif and notif.user_id == u.id:
-        notif.is_read = True
+    # Ownership check lives in the WHERE clause; one UPDATE in the common case
+    marked = Notification.query.filter_by(id=nid, user_id=u.id, is_read=False) \
+        .update({"is_read": True}, synchronize_session=False)
+    if marked:
         db.session.commit()
+        forget_unread(NOTIF_UNREAD_KEY, u.id)
+        return {"success": True}
+    # Nothing updated: already read (fine) or not this user's notification
+    if db.session.query(Notification.id).filter_by(id=nid, user_id=u.id).first():
         return {"success": True}
     return {"error": "Not found"}, 404
 
 @app.route("/api/notifications/unread")
+@conditional_json
 def unread_notifications():
     u = current_user()
     if not u:
         return {"count": 0}
-    count = Notification.query.filter_by(user_id=u.id, is_read=False).count()
+    count = unread_count(NOTIF_UNREAD_KEY, u.id,
+                         lambda: Notification.query.filter_by(user_id=u.id, is_read=False).count())
     return {"count": count}
 
 @app.route("/api/voice/join/<int:cid>", methods=["POST"])
 def join_voice(cid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
-    # Remove any existing participation
-    VoiceParticipant.query.filter_by(user_id=u.id).delete()
-    # Add to this channel
-    db.session.add(VoiceParticipant(user_id=u.id, channel_id=cid))
+    # A user is in at most one voice channel: move any existing participation here
+    upsert(VoiceParticipant, "user_id", user_id=u.id, channel_id=cid, is_muted=False, joined_at=datetime.utcnow())
     db.session.commit()
     return {"success": True}
 
 @app.route("/api/voice/leave/<int:cid>", methods=["POST"])
 def leave_voice(cid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
     VoiceParticipant.query.filter_by(user_id=u.id, channel_id=cid).delete()
@@ -1617,7 +2527,7 @@ def leave_voice(cid):
 
 @app.route("/api/voice/mute/<int:cid>", methods=["POST"])
 def mute_voice(cid):
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
     part = VoiceParticipant.query.filter_by(user_id=u.id, channel_id=cid).first()
@@ -1628,7 +2538,7 @@ def mute_voice(cid):
 
 @app.route("/api/channel/create", methods=["POST"])
 def create_channel():
-    u = current_user()
+    u = current_user_row()
     if not u:
         return {"error": "Not logged in"}, 401
     
@@ -1662,29 +2572,59 @@ def create_channel():
     return {"success": True, "channel_id": channel.id}
 
 @app.route("/api/voice/counts/<slug>")
+@conditional_json
 def voice_counts(slug):
     server = Server.query.filter_by(slug=slug).first()
     if not server:
         return {"error": "Server not found"}, 404
     
-    # Get all voice channels for this server
-    channels = Channel.query.filter_by(server_id=server.id, is_voice=True).all()
-    counts = {}
-    for ch in channels:
-        count = VoiceParticipant.query.filter_by(channel_id=ch.id).count()
-        counts[ch.id] = count
-    
-    return counts
+    # Participants per voice channel in one query; empty channels come back as 0
+    rows = db.session.execute(
+        select(Channel.id, func.count(VoiceParticipant.id))
+        .outerjoin(VoiceParticipant, VoiceParticipant.channel_id == Channel.id)
+        .where(Channel.server_id == server.id, Channel.is_voice == True)
+        .group_by(Channel.id)).all()
+    return {cid: count for cid, count in rows}
 
 # ============ Music Bot ============
+_YT_RE = re.compile(r'(?:youtube\.com/watch\?v=|youtu\.be/)([a-zA-Z0-9_-]+)')
+
+def with_active_bot(view):
+    """Require a login and an active bot in channel `cid`; passes them in as `user` and `bot`."""
+    @wraps(view)
+    def wrapper(cid, **kwargs):
+        user = current_user_row()
+        if not user:
+            return {"error": "Not logged in"}, 401
+        bot = (MusicBot.query
+               .options(load_only(MusicBot.is_active, MusicBot.is_playing, MusicBot.is_paused,
+                                  MusicBot.current_song, MusicBot.current_song_title, MusicBot.loop_mode,
+                                  MusicBot.is_shuffled, MusicBot.last_activity))
+               .filter_by(channel_id=cid).first())
+        if not bot or not bot.is_active:
+            return {"error": "Bot not active"}, 404
+        return view(cid, bot=bot, user=user, **kwargs)
+    return wrapper
+
+def _renumber_queue(rows):
+    """Write positions 1..n for (id, position) rows in their given order, in one executemany.
+
+    Rows already at the right position are skipped.
+    """
+    params = [{"qid": qid, "pos": idx} for idx, (qid, pos) in enumerate(rows, start=1) if pos != idx]
+    if params:
+        queue = MusicQueue.__table__
+        db.session.execute(update(queue).where(queue.c.id == bindparam("qid"))
+                           .values(position=bindparam("pos")), params)
+
 @app.route("/api/music/bot/invite/<int:cid>", methods=["POST"])
 def music_bot_invite(cid):
     """Invite music bot to a voice channel"""
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
-    channel = Channel.query.get(cid)
+    channel = db.session.get(Channel, cid)
     if not channel or not channel.is_voice:
         return {"error": "Voice channel not found"}, 404
     
@@ -1703,7 +2643,7 @@ def music_bot_invite(cid):
 @app.route("/api/music/bot/kick/<int:cid>", methods=["POST"])
 def music_bot_kick(cid):
     """Remove music bot from a voice channel"""
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -1725,16 +2665,9 @@ def music_bot_kick(cid):
     return {"success": True}
 
 @app.route("/api/music/bot/play/<int:cid>", methods=["POST"])
-def music_bot_play(cid):
+@with_active_bot
+def music_bot_play(cid, bot, user):
     """Add a song to queue and play"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active in this channel"}, 404
-    
     data = request.get_json() or {}
     song_url = data.get("url", "")
     song_title = data.get("title", "")
@@ -1743,8 +2676,7 @@ def music_bot_play(cid):
         return {"error": "No URL provided"}, 400
     
     # Extract video ID from YouTube URL
-    import re
-    youtube_match = re.search(r'(?:youtube\.com/watch\?v=|youtu\.be/)([a-zA-Z0-9_-]+)', song_url)
+    youtube_match = _YT_RE.search(song_url)
     if youtube_match:
         video_id = youtube_match.group(1)
         if not song_title:
@@ -1782,16 +2714,9 @@ def music_bot_play(cid):
     return {"success": True, "position": queue_item.position, "title": song_title}
 
 @app.route("/api/music/bot/skip/<int:cid>", methods=["POST"])
-def music_bot_skip(cid):
+@with_active_bot
+def music_bot_skip(cid, bot, user):
     """Skip current song"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active"}, 404
-    
     # Mark current song as played
     if bot.current_song:
         current = MusicQueue.query.filter_by(
@@ -1822,16 +2747,9 @@ def music_bot_skip(cid):
     return {"success": True, "next_song": bot.current_song_title}
 
 @app.route("/api/music/bot/pause/<int:cid>", methods=["POST"])
-def music_bot_pause(cid):
+@with_active_bot
+def music_bot_pause(cid, bot, user):
     """Pause/resume playback"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active"}, 404
-    
     bot.is_paused = not bot.is_paused
     bot.last_activity = datetime.utcnow()
     db.session.commit()
@@ -1839,16 +2757,9 @@ def music_bot_pause(cid):
     return {"success": True, "paused": bot.is_paused}
 
 @app.route("/api/music/bot/stop/<int:cid>", methods=["POST"])
-def music_bot_stop(cid):
+@with_active_bot
+def music_bot_stop(cid, bot, user):
     """Stop playback and clear queue"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active"}, 404
-    
     bot.is_playing = False
     bot.is_paused = False
     bot.current_song = None
@@ -1862,16 +2773,9 @@ def music_bot_stop(cid):
     return {"success": True}
 
 @app.route("/api/music/bot/loop/<int:cid>", methods=["POST"])
-def music_bot_loop(cid):
+@with_active_bot
+def music_bot_loop(cid, bot, user):
     """Toggle loop mode: off -> one -> all -> off"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active"}, 404
-    
     # Cycle through loop modes
     if bot.loop_mode == "off":
         bot.loop_mode = "one"
@@ -1886,30 +2790,22 @@ def music_bot_loop(cid):
     return {"success": True, "loop_mode": bot.loop_mode}
 
 @app.route("/api/music/bot/shuffle/<int:cid>", methods=["POST"])
-def music_bot_shuffle(cid):
+@with_active_bot
+def music_bot_shuffle(cid, bot, user):
     """Toggle shuffle mode and reorder queue"""
-    user = current_user()
-    if not user:
-        return {"error": "Not logged in"}, 401
-    
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
-    if not bot or not bot.is_active:
-        return {"error": "Bot not active"}, 404
-    
     bot.is_shuffled = not bot.is_shuffled
     
+    # Unshuffled order is insertion order (by id)
+    ids = db.session.scalars(select(MusicQueue.id).filter_by(channel_id=cid, is_played=False)
+                             .order_by(MusicQueue.id)).all()
     if bot.is_shuffled:
-        # Shuffle the queue
-        import random
-        queue_items = MusicQueue.query.filter_by(channel_id=cid, is_played=False).all()
-        random.shuffle(queue_items)
-        for idx, item in enumerate(queue_items, start=1):
-            item.position = idx
-    else:
-        # Restore original order (by id)
-        queue_items = MusicQueue.query.filter_by(channel_id=cid, is_played=False).order_by(MusicQueue.id).all()
-        for idx, item in enumerate(queue_items, start=1):
-            item.position = idx
+        random.shuffle(ids)
+    if ids:
+        # One UPDATE ... SET position = CASE id WHEN .. THEN .. END for the whole queue
+        queue = MusicQueue.__table__
+        db.session.execute(update(queue).where(queue.c.id.in_(ids))
+                           .values(position=case({qid: pos for pos, qid in enumerate(ids, start=1)},
+                                                 value=queue.c.id)))
     
     bot.last_activity = datetime.utcnow()
     db.session.commit()
@@ -1919,7 +2815,7 @@ def music_bot_shuffle(cid):
 @app.route("/api/music/bot/remove/<int:cid>/<int:queue_id>", methods=["POST"])
 def music_bot_remove(cid, queue_id):
     """Remove a song from queue"""
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -1928,25 +2824,30 @@ def music_bot_remove(cid, queue_id):
         return {"error": "Song not found in queue"}, 404
     
     db.session.delete(queue_item)
+    db.session.flush()
     
     # Reorder remaining queue items
-    remaining = MusicQueue.query.filter_by(channel_id=cid, is_played=False).order_by(MusicQueue.position).all()
-    for idx, item in enumerate(remaining, start=1):
-        item.position = idx
+    remaining = db.session.execute(select(MusicQueue.id, MusicQueue.position)
+                                   .filter_by(channel_id=cid, is_played=False)
+                                   .order_by(MusicQueue.position)).all()
+    _renumber_queue(remaining)
     
     db.session.commit()
     return {"success": True}
 
 @app.route("/api/music/bot/queue/<int:cid>")
+@conditional_json
 def music_bot_queue(cid):
     """Get current queue"""
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
+    bot = db.session.execute(select(
+        MusicBot.is_active, MusicBot.is_playing, MusicBot.is_paused, MusicBot.current_song_title,
+        MusicBot.loop_mode, MusicBot.is_shuffled).filter_by(channel_id=cid)).first()
     if not bot:
         return {"error": "Bot not found"}, 404
     
-    queue = MusicQueue.query.filter_by(
-        channel_id=cid, is_played=False
-    ).order_by(MusicQueue.position).all()
+    queue = db.session.execute(select(
+        MusicQueue.id, MusicQueue.song_title, MusicQueue.song_url, MusicQueue.position
+    ).filter_by(channel_id=cid, is_played=False).order_by(MusicQueue.position)).all()
     
     return {
         "bot_active": bot.is_active,
@@ -1959,9 +2860,12 @@ def music_bot_queue(cid):
     }
 
 @app.route("/api/music/bot/status/<int:cid>")
+@conditional_json
 def music_bot_status(cid):
     """Get bot status"""
-    bot = MusicBot.query.filter_by(channel_id=cid).first()
+    bot = db.session.execute(select(
+        MusicBot.is_active, MusicBot.is_playing, MusicBot.is_paused, MusicBot.current_song,
+        MusicBot.current_song_title, MusicBot.loop_mode, MusicBot.is_shuffled).filter_by(channel_id=cid)).first()
     
     return {
         "active": bot.is_active if bot else False,
@@ -1973,6 +2877,59 @@ def music_bot_status(cid):
         "is_shuffled": bot.is_shuffled if bot else False
     }
 
+# YouTube search: one keep-alive HTTP session per process, results cached for a few minutes
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    # requests not installed, searches open a fresh urllib connection each time
+    requests = None
+
+YT_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+YT_SEARCH_TTL = 300
+YT_SEARCH_KEY = "yt:{}"
+# Matched against the raw page bytes: one scan, no decode of the whole ~1 MB page
+_YT_INIT_RE = re.compile(rb'var ytInitialData\s*=\s*(\{.*?\});</script>', re.DOTALL)
+_yt_search_cache = {}  # normalized query -> (expires_at, results), used without Redis
+
+_yt_session = None
+if requests:
+    _yt_session = requests.Session()
+    _yt_session.headers.update(YT_HEADERS)
+    _yt_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+def _yt_fetch(url: str) -> bytes:
+    if _yt_session:
+        resp = _yt_session.get(url, timeout=5)
+        resp.raise_for_status()
+        return resp.content
+    req = urllib.request.Request(url, headers=YT_HEADERS)
+    with urllib.request.urlopen(req, timeout=5) as response:
+        return response.read()
+
+def _yt_cached_results(key: str):
+    if redis_client:
+        try:
+            cached = redis_client.get(YT_SEARCH_KEY.format(key))
+            return json.loads(cached) if cached is not None else None
+        except Exception:
+            pass
+    hit = _yt_search_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+def _yt_store_results(key: str, results: list):
+    if redis_client:
+        try:
+            redis_client.setex(YT_SEARCH_KEY.format(key), YT_SEARCH_TTL, json.dumps(results))
+            return
+        except Exception:
+            pass
+    if len(_yt_search_cache) >= 500:
+        _yt_search_cache.clear()
+    _yt_search_cache[key] = (time.monotonic() + YT_SEARCH_TTL, results)
+
 @app.route("/api/music/search")
 def music_search():
     """Search YouTube videos"""
@@ -1980,26 +2937,24 @@ def music_search():
     if not query:
         return {"error": "No query provided"}, 400
     
+    cache_key = " ".join(query.lower().split())
+    cached = _yt_cached_results(cache_key)
+    if cached is not None:
+        return {"results": cached}
+    
     try:
-        import urllib.request
-        import json
-        
         # Use YouTube's internal API (no key needed, used by youtube.com itself)
-        search_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(query)}"
+        search_url = f"https://www.youtube.com/results?search_query={quote(query)}"
         
         # Fetch the page
-        req = urllib.request.Request(search_url, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
-        
-        with urllib.request.urlopen(req, timeout=5) as response:
-            html = response.read().decode('utf-8')
+        page = _yt_fetch(search_url)
         
         # Extract JSON data from the page
-        start = html.find('var ytInitialData = ') + len('var ytInitialData = ')
-        end = html.find(';</script>', start)
-        json_str = html[start:end]
-        data = json.loads(json_str)
+        m = _YT_INIT_RE.search(page)
+        if not m:
+            print("[music] ytInitialData not found in search page")
+            return {"results": []}
+        data = (orjson or json).loads(m.group(1))
         
         # Parse video results
         results = []
@@ -2025,6 +2980,8 @@ def music_search():
         except:
             pass
         
+        if results:
+            _yt_store_results(cache_key, results)
         return {"results": results}
     
     except Exception as e:
@@ -2034,38 +2991,39 @@ def music_search():
 @app.route("/api/music/bot/cleanup")
 def music_bot_cleanup():
     """Remove inactive bots from empty channels"""
-    from datetime import timedelta
-    
-    # Get all active bots
-    active_bots = MusicBot.query.filter_by(is_active=True).all()
-    kicked_count = 0
-    
-    for bot in active_bots:
-        # Check if channel has any participants
-        participant_count = VoiceParticipant.query.filter_by(channel_id=bot.channel_id).count()
-        
-        # If empty for more than 1 minute (60 seconds)
-        if participant_count == 0:
-            time_inactive = datetime.utcnow() - bot.last_activity
-            if time_inactive > timedelta(seconds=60):
-                # Kick the bot
-                bot.is_active = False
-                bot.is_playing = False
-                bot.is_paused = False
-                bot.current_song = None
-                bot.current_song_title = None
-                
-                # Clear queue
-                MusicQueue.query.filter_by(channel_id=bot.channel_id, is_played=False).delete()
-                
-                kicked_count += 1
-    
-    if kicked_count > 0:
+    # Active bots idle for more than 1 minute (60 seconds) in channels nobody is in
+    occupied = select(VoiceParticipant.id).where(VoiceParticipant.channel_id == MusicBot.channel_id).exists()
+    stale = db.session.execute(
+        select(MusicBot.id, MusicBot.channel_id)
+        .where(MusicBot.is_active == True,
+               MusicBot.last_activity < datetime.utcnow() - timedelta(seconds=60),
+               ~occupied)).all()
+    
+    if stale:
+        # Kick the bots and clear their queues
+        db.session.execute(update(MusicBot).where(MusicBot.id.in_([b.id for b in stale]))
+                           .values(is_active=False, is_playing=False, is_paused=False,
+                                   current_song=None, current_song_title=None),
+                           execution_options={"synchronize_session": False})
+        MusicQueue.query.filter(MusicQueue.channel_id.in_([b.channel_id for b in stale]),
+                                MusicQueue.is_played == False).delete(synchronize_session=False)
         db.session.commit()
     
-    return {"kicked": kicked_count}
+    return {"kicked": len(stale)}
 
 # ============ Friends & Messaging ============
+def friends_query(user_id: int, *columns):
+    """Accepted friends of user_id, whichever side sent the request, as one query.
+
+    Yields User objects, or plain rows of the given columns when any are passed.
+    """
+    other_id = case((Friendship.user_id == user_id, Friendship.friend_id), else_=Friendship.user_id)
+    return (db.session.query(*(columns or (User,)))
+            .join(Friendship, User.id == other_id)
+            .filter(or_(Friendship.user_id == user_id, Friendship.friend_id == user_id),
+                    Friendship.status == "accepted")
+            .distinct())
+
 @app.route("/friends")
 def friends():
     user = current_user()
@@ -2073,11 +3031,7 @@ def friends():
         return redirect(url_for("login"))
     
     # Get accepted friends
-    friends_list = db.session.query(User).join(
-        Friendship, 
-        ((Friendship.user_id == user.id) & (Friendship.friend_id == User.id)) |
-        ((Friendship.friend_id == user.id) & (Friendship.user_id == User.id))
-    ).filter(Friendship.status == "accepted").all()
+    friends_list = friends_query(user.id).all()
     
     # Get pending friend requests (received)
     pending = db.session.query(User, Friendship).join(
@@ -2087,7 +3041,7 @@ def friends():
         Friendship.status == "pending"
     ).all()
     
-    return render_template("friends.html", user=user, friends=friends_list, pending=pending, servers=Server.query.all(), sponsors=Sponsor.query.all(), app_version=APP_VERSION)
+    return render_template("friends.html", user=user, friends=friends_list, pending=pending)
 
 @app.route("/members")
 def members():
@@ -2110,7 +3064,7 @@ def members():
         else:
             friend_ids.add(f.user_id)
     
-    return render_template("members.html", user=user, members=all_members, friend_ids=friend_ids, servers=Server.query.all(), sponsors=Sponsor.query.all(), app_version=APP_VERSION)
+    return render_template("members.html", user=user, members=all_members, friend_ids=friend_ids)
 
 @app.route("/messages")
 @app.route("/messages/<int:friend_id>")
@@ -2120,41 +3074,42 @@ def messages(friend_id=None):
         return redirect(url_for("login"))
     
     # Get friends list
-    friends_list = db.session.query(User).join(
-        Friendship,
-        ((Friendship.user_id == user.id) & (Friendship.friend_id == User.id)) |
-        ((Friendship.friend_id == user.id) & (Friendship.user_id == User.id))
-    ).filter(Friendship.status == "accepted").all()
+    friends_list = friends_query(user.id).all()
     
     # Get conversation if friend selected
     conversation = []
     active_friend = None
     if friend_id:
-        active_friend = User.query.get(friend_id)
+        active_friend = db.session.get(User, friend_id)
         if active_friend:
             conversation = DirectMessage.query.filter(
                 ((DirectMessage.sender_id == user.id) & (DirectMessage.recipient_id == friend_id)) |
                 ((DirectMessage.sender_id == friend_id) & (DirectMessage.recipient_id == user.id))
             ).order_by(DirectMessage.created_at).all()
             
-            # Mark messages as read
-            DirectMessage.query.filter_by(sender_id=friend_id, recipient_id=user.id, is_read=False).update({"is_read": True})
-            db.session.commit()
+            # Mark messages as read; an already-read conversation costs no write transaction
+            marked = DirectMessage.query.filter_by(sender_id=friend_id, recipient_id=user.id, is_read=False) \
+                .update({"is_read": True}, synchronize_session=False)
+            if marked:
+                db.session.commit()
+                forget_unread(MSG_UNREAD_KEY, user.id)
     
-    # Get unread message counts
-    unread_counts = {}
-    for friend in friends_list:
-        count = DirectMessage.query.filter_by(sender_id=friend.id, recipient_id=user.id, is_read=False).count()
-        unread_counts[friend.id] = count
+    # Unread message counts per friend, one GROUP BY instead of a COUNT per friend
+    unread_counts = {f.id: 0 for f in friends_list}
+    if unread_counts:
+        unread_counts.update(db.session.execute(
+            select(DirectMessage.sender_id, func.count(DirectMessage.id))
+            .where(DirectMessage.recipient_id == user.id, DirectMessage.is_read == False,
+                   DirectMessage.sender_id.in_(list(unread_counts)))
+            .group_by(DirectMessage.sender_id)).all())
     
     return render_template("messages.html", user=user, friends=friends_list, active_friend=active_friend, 
-                         conversation=conversation, unread_counts=unread_counts, servers=Server.query.all(), 
-                         sponsors=Sponsor.query.all(), app_version=APP_VERSION)
+                         conversation=conversation, unread_counts=unread_counts)
 
 # ============ API: Friends ============
 @app.route("/api/friend/add/<int:friend_id>", methods=["POST"])
 def add_friend(friend_id):
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -2170,41 +3125,37 @@ def add_friend(friend_id):
     # Create friend request
     friendship = Friendship(user_id=user.id, friend_id=friend_id, status="pending")
     db.session.add(friendship)
-    db.session.commit()
     
-    # Create notification for recipient
-    friend = User.query.get(friend_id)
+    # Create notification for recipient (same commit as the request)
+    friend = db.session.get(User, friend_id)
     if friend:
-        notif = Notification(user_id=friend_id, message=f"{user.username} sent you a friend request", link=url_for("friends"))
-        db.session.add(notif)
-        db.session.commit()
+        add_notification(friend_id, f"{user.username} sent you a friend request", url_for("friends"))
+    db.session.commit()
     
     return {"success": True}
 
 @app.route("/api/friend/accept/<int:friendship_id>", methods=["POST"])
 def accept_friend(friendship_id):
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
-    friendship = Friendship.query.get(friendship_id)
+    friendship = db.session.get(Friendship, friendship_id)
     if not friendship or friendship.friend_id != user.id:
         return {"error": "Invalid request"}, 400
     
     friendship.status = "accepted"
     friendship.accepted_at = datetime.utcnow()
-    db.session.commit()
     
     # Notify requester
-    notif = Notification(user_id=friendship.user_id, message=f"{user.username} accepted your friend request", link=url_for("messages", friend_id=user.id))
-    db.session.add(notif)
+    add_notification(friendship.user_id, f"{user.username} accepted your friend request", url_for("messages", friend_id=user.id))
     db.session.commit()
     
     return {"success": True}
 
 @app.route("/api/friend/remove/<int:friend_id>", methods=["POST"])
 def remove_friend(friend_id):
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -2222,7 +3173,7 @@ def remove_friend(friend_id):
 # ============ API: Messages ============
 @app.route("/api/message/send/<int:recipient_id>", methods=["POST"])
 def send_message(recipient_id):
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -2242,12 +3193,11 @@ def send_message(recipient_id):
     
     msg = DirectMessage(sender_id=user.id, recipient_id=recipient_id, content=content)
     db.session.add(msg)
-    db.session.commit()
     
-    # Create notification
-    notif = Notification(user_id=recipient_id, message=f"New message from {user.username}", link=url_for("messages", friend_id=user.id))
-    db.session.add(notif)
+    # Create notification (same commit as the message)
+    add_notification(recipient_id, f"New message from {user.username}", url_for("messages", friend_id=user.id))
     db.session.commit()
+    forget_unread(MSG_UNREAD_KEY, recipient_id)
     
     return {"success": True, "message": {
         "id": msg.id,
@@ -2257,17 +3207,23 @@ def send_message(recipient_id):
     }}
 
 @app.route("/api/messages/unread")
+@conditional_json
 def unread_messages():
     user = current_user()
     if not user:
         return {"error": "Not logged in"}, 401
     
-    count = DirectMessage.query.filter_by(recipient_id=user.id, is_read=False).count()
+    count = unread_count(MSG_UNREAD_KEY, user.id,
+                         lambda: DirectMessage.query.filter_by(recipient_id=user.id, is_read=False).count())
     return {"count": count}
 
+# Whether user.status is "offline" ("1"/"0"), so heartbeats only hit the database to come back online
+STATUS_OFFLINE_KEY = "status:offline:{}"
+STATUS_TTL = 3600
+
 @app.route("/api/status/update", methods=["POST"])
 def update_status():
-    user = current_user()
+    user = current_user_row()
     if not user:
         return {"error": "Not logged in"}, 401
     
@@ -2280,9 +3236,44 @@ def update_status():
     user.status = new_status
     user.last_seen = datetime.utcnow()
     db.session.commit()
+    if redis_client and celery_app:
+        try:
+            redis_client.set(STATUS_OFFLINE_KEY.format(user.id), "1" if new_status == "offline" else "0", ex=STATUS_TTL)
+        except Exception as e:
+            print(f"[status] Could not cache status: {e}")
     
     return {"success": True, "status": new_status}
 
+LAST_SEEN_KEY = "last_seen"
+
+def flush_last_seen() -> int:
+    """Write heartbeat times buffered in Redis to user.last_seen. Returns users updated."""
+    if not redis_client:
+        return 0
+    # HGETALL + DEL in one MULTI so heartbeats landing mid-flush are kept for the next run
+    pipe = redis_client.pipeline()
+    pipe.hgetall(LAST_SEEN_KEY)
+    pipe.delete(LAST_SEEN_KEY)
+    seen, _ = pipe.execute()
+    if not seen:
+        return 0
+    users = User.__table__
+    ts = bindparam("ts")
+    db.session.execute(
+        update(users).where(users.c.id == bindparam("uid"))
+        # Never move last_seen backwards past a newer direct write (e.g. a status change)
+        .values(last_seen=case((users.c.last_seen == None, ts), (users.c.last_seen < ts, ts),
+                               else_=users.c.last_seen)),
+        [{"uid": int(uid), "ts": datetime.utcfromtimestamp(int(t))} for uid, t in seen.items()])
+    db.session.commit()
+    return len(seen)
+
+if celery_app:
+    @celery_app.task(name="cannaspot.flush_last_seen")
+    def flush_last_seen_task():
+        with app.app_context():
+            return flush_last_seen()
+
 @app.route("/api/status/heartbeat", methods=["POST"])
 def status_heartbeat():
     """Update last_seen timestamp to track online status"""
@@ -2290,9 +3281,28 @@ def status_heartbeat():
     if not user:
         return {"error": "Not logged in"}, 401
     
-    user.last_seen = datetime.utcnow()
-    if user.status == "offline":
-        user.status = "online"
+    now = datetime.utcnow()
+    if redis_client and celery_app:
+        try:
+            # Buffered; flush_last_seen writes them out in one batch every few minutes
+            pipe = redis_client.pipeline()
+            pipe.hset(LAST_SEEN_KEY, user.id, int(time.time()))
+            pipe.get(STATUS_OFFLINE_KEY.format(user.id))
+            _, offline = pipe.execute()
+            # Only coming back from "offline" needs a write now; skipped while the cache says otherwise
+            if offline != b"0":
+                if db.session.execute(update(User).where(User.id == user.id, User.status == "offline")
+                                      .values(status="online", last_seen=now)).rowcount:
+                    db.session.commit()
+                redis_client.set(STATUS_OFFLINE_KEY.format(user.id), "0", ex=STATUS_TTL)
+            return {"success": True}
+        except Exception as e:
+            print(f"[status] Redis unavailable, writing directly: {e}")
+            db.session.rollback()
+    
+    db.session.execute(update(User).where(User.id == user.id).values(
+        last_seen=now,
+        status=case((User.status == "offline", "online"), else_=User.status)))
     db.session.commit()
     
     return {"success": True}
@@ -2318,6 +3328,7 @@ def get_custom_emojis():
     return {"success": True, "emojis": grouped}
 
 @app.route("/api/friends/status")
+@conditional_json
 def api_friends_status():
     """Return the statuses for accepted friends of the current user.
     Used by the friends page to update presence without full reload.
@@ -2325,16 +3336,8 @@ def api_friends_status():
     u = current_user()
     if not u:
         return {"error": "Not logged in"}, 401
-    # Accepted friendships where current user is either side
-    friends_a = db.session.query(User).join(Friendship, Friendship.friend_id == User.id) \
-        .filter(Friendship.user_id == u.id, Friendship.status == 'accepted').all()
-    friends_b = db.session.query(User).join(Friendship, Friendship.user_id == User.id) \
-        .filter(Friendship.friend_id == u.id, Friendship.status == 'accepted').all()
-    friends = {f.id: f for f in friends_a}
-    for f in friends_b:
-        friends[f.id] = f
     data = []
-    for f in friends.values():
+    for f in friends_query(u.id, User.id, User.status, User.last_seen):
         data.append({
             "id": f.id,
             "status": f.status or "offline",
@@ -2342,32 +3345,157 @@ def api_friends_status():
         })
     return {"success": True, "friends": data}
 
-@app.route("/health")
-def health_check():
-    """Health check endpoint for deployment platforms."""
-    try:
-        # Check database connection
-        db.session.execute(db.text("SELECT 1"))
-        db_status = "healthy"
-    except Exception as e:
-        db_status = f"unhealthy: {str(e)}"
-    
+# The DB probe runs on its own thread with a hard deadline so a stalled database
+# answers "degraded" quickly instead of pinning the request thread
+HEALTH_TIMEOUT = 1.5
+# Probe bursts (load balancers, liveness checks) within this window share one result
+HEALTH_CACHE_TTL = 2.0
+# Once expired, a result this recent is still served while a background probe refreshes it;
+# only callers with nothing recent enough wait on the probe
+HEALTH_STALE_GRACE = 10.0
+# Sent as-is through exec_driver_sql: no text() construct, compile step or statement-cache lookup per probe
+HEALTH_SQL = "SELECT 1"
+_health_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="health")
+_health_lock = threading.Lock()
+_health_future = None
+_health_cached = None  # (expires_at, payload)
+_health_engine = None
+
+# Upload dirs are created at startup and rarely change; re-stat them at most once a minute
+UPLOAD_DIRS_RECHECK = 60.0
+_upload_dirs_cached = None  # (expires_at, {name: exists})
+
+def _upload_dirs_status() -> dict:
+    global _upload_dirs_cached
+    cached = _upload_dirs_cached
+    if cached is None or cached[0] <= time.monotonic():
+        # All three live directly under UPLOAD_DIR: one directory read answers them, and
+        # DirEntry.is_dir() uses the type readdir already returned instead of a stat per dir
+        try:
+            with os.scandir(UPLOAD_DIR) as it:
+                present = {e.name for e in it if e.is_dir()}
+        except OSError:
+            present = set()
+        status = {name: os.path.basename(path) in present
+                  for name, path in (("videos", VIDEO_DIR), ("thumbnails", THUMB_DIR), ("avatars", AVATAR_DIR))}
+        cached = _upload_dirs_cached = (time.monotonic() + UPLOAD_DIRS_RECHECK, status)
+    return cached[1]
+
+def _health_probe_engine(app_engine):
+    # Probes connect through their own unpooled engine: they never wait behind requests for a
+    # pool slot, and each one proves a fresh connection can still be opened
+    global _health_engine
+    if _health_engine is None:
+        connect_args = {"connect_timeout": 1} if app_engine.dialect.name in ("postgresql", "mysql") else {}
+        _health_engine = create_engine(app_engine.url, poolclass=NullPool, connect_args=connect_args)
+        if prometheus_client:
+            event.listen(_health_engine, "checkout",
+                         lambda *_: DB_CHECKOUTS.labels(pool="health", endpoint="health_check").inc())
+    return _health_engine
+
+def _probe_db(engine):
+    # A bare engine connection closed on exit: no scoped-session state, no flush,
+    # nothing left for request teardown
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            # Applies to this probe's transaction only
+            conn.exec_driver_sql("SET LOCAL statement_timeout = '500ms'")
+        conn.exec_driver_sql(HEALTH_SQL)
+
+def _pool_stats(engine):
+    # QueuePool counters are plain attribute reads; other pool classes don't track them
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return None
+    return {"size": pool.size(), "checked_out": pool.checkedout(), "overflow": max(pool.overflow(), 0)}
+
+def _health_payload(db_status: str, engine) -> dict:
     return {
         "status": "healthy" if db_status == "healthy" else "degraded",
         "version": APP_VERSION,
         "database": db_status,
-        "upload_dirs": {
-            "videos": os.path.exists(VIDEO_DIR),
-            "thumbnails": os.path.exists(THUMB_DIR),
-            "avatars": os.path.exists(AVATAR_DIR)
-        }
+        "db_pool": _pool_stats(engine),
+        "upload_dirs": _upload_dirs_status()
     }
 
+def _probe_status(future) -> str:
+    exc = future.exception()
+    return "healthy" if exc is None else f"unhealthy: {str(exc)}"
+
+def _probe_done(future, engine):
+    # Runs on the health thread, so background refreshes land in the cache without a waiter
+    global _health_cached
+    _health_cached = (time.monotonic() + HEALTH_CACHE_TTL, _health_payload(_probe_status(future), engine))
+
+@app.route("/health")
+def health_check():
+    """Health check endpoint for deployment platforms."""
+    global _health_future, _health_cached
+    now = time.monotonic()
+    cached = _health_cached
+    if cached is None or cached[0] <= now:
+        engine = db.engine
+        with _health_lock:
+            # Probes arriving while one is still running share it rather than queueing more
+            if _health_future is None or _health_future.done():
+                _health_future = _health_executor.submit(_probe_db, _health_probe_engine(engine))
+                _health_future.add_done_callback(lambda f: _probe_done(f, engine))
+            future = _health_future
+        if cached is None or cached[0] + HEALTH_STALE_GRACE <= now:
+            try:
+                # Check database connection
+                future.result(timeout=HEALTH_TIMEOUT)
+                db_status = "healthy"
+            except FutureTimeout:
+                db_status = "unhealthy: timeout"
+            except Exception:
+                db_status = _probe_status(future)
+            cached = _health_cached = (time.monotonic() + HEALTH_CACHE_TTL, _health_payload(db_status, engine))
+    
+    # Load balancers key off the status code alone; the body is for humans
+    payload = cached[1]
+    resp = make_response(payload, 200 if payload["status"] == "healthy" else 503)
+    resp.cache_control.max_age = int(HEALTH_CACHE_TTL)
+    return resp
+
+# Optional Prometheus metrics: connection checkouts attributed to the endpoint that made them,
+# so a view that starts holding (or leaking) connections shows up before the pool runs dry.
+# Values are per worker process.
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+if prometheus_client:
+    DB_CHECKOUTS = prometheus_client.Counter(
+        "cannaspot_db_pool_checkouts_total", "Database connections checked out", ["pool", "endpoint"])
+    DB_CHECKED_OUT = prometheus_client.Gauge(
+        "cannaspot_db_pool_checked_out", "App pool connections currently checked out")
+
+    def _count_checkout(dbapi_conn, record, proxy):
+        endpoint = (request.endpoint or "unmatched") if has_request_context() else "background"
+        DB_CHECKOUTS.labels(pool="app", endpoint=endpoint).inc()
+
+    with app.app_context():
+        _app_engine = db.engine
+    # Engine-level listeners carry over to the pool a forked worker recreates on dispose()
+    event.listen(_app_engine, "checkout", _count_checkout)
+
+    def _checked_out():
+        stats = _pool_stats(_app_engine)
+        return stats["checked_out"] if stats else 0
+
+    DB_CHECKED_OUT.set_function(_checked_out)  # read at scrape time
+
+    @app.route("/metrics")
+    def metrics():
+        resp = make_response(prometheus_client.generate_latest())
+        resp.headers["Content-Type"] = prometheus_client.CONTENT_TYPE_LATEST
+        return resp
+
 if __name__ == "__main__":
     # Production: Set debug=False and use gunicorn
     # Development: debug=True
-    import os
-    debug_mode = os.environ.get("FLASK_ENV") != "production"
-    app.run(host="0.0.0.0", port=5000, debug=debug_mode)
+    app.run(host="0.0.0.0", port=5000, debug=DEBUG_MODE)
 
  
@@ -0,0 +1,13 @@
+# Gunicorn reads ./gunicorn.conf.py automatically, so these apply to the Procfile,
+# start_gunicorn.sh and deploy/gunicorn.service commands alike.
+
+# Import the app (and run its boot-time table setup) once in the master, then fork workers
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Pooled DB connections opened in the master while preloading must not be shared with
+    # the children; give each worker a fresh pool without closing the parent's sockets
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -155,6 +155,50 @@ def migrate():
             )
         """))
     
+    # Indexes for hot queries (db.create_all only adds these to brand-new tables)
+    indexes = [
+        ("ix_video_uploader_created", "CREATE INDEX ix_video_uploader_created ON video (uploader_id, created_at)"),
+        ("ix_message_channel_created", "CREATE INDEX ix_message_channel_created ON message (channel_id, created_at)"),
+        ("ix_message_created", "CREATE INDEX ix_message_created ON message (created_at)"),
+        ("ix_videolike_video", "CREATE INDEX ix_videolike_video ON video_like (video_id)"),
+        ("ix_rtc_poll_room_id", "CREATE INDEX ix_rtc_poll_room_id ON rtc_signal (room, id)"),
+        ("ix_video_created", "CREATE INDEX ix_video_created ON video (created_at)"),
+        ("ix_videolike_user_created", "CREATE INDEX ix_videolike_user_created ON video_like (user_id, created_at)"),
+        ("ix_watchlater_user_added", "CREATE INDEX ix_watchlater_user_added ON watch_later (user_id, added_at)"),
+        ("ix_short_created", "CREATE INDEX ix_short_created ON short (created_at)"),
+        ("ix_voiceparticipant_channel", "CREATE INDEX ix_voiceparticipant_channel ON voice_participant (channel_id)"),
+        ("uq_emoji_cat", "CREATE UNIQUE INDEX uq_emoji_cat ON custom_emoji (emoji_char, category)"),
+        ("ix_notification_user_read", "CREATE INDEX ix_notification_user_read ON notification (user_id, is_read)"),
+        ("ix_dm_recipient_read", "CREATE INDEX ix_dm_recipient_read ON direct_message (recipient_id, is_read)"),
+        ("ix_dm_pair_created", "CREATE INDEX ix_dm_pair_created ON direct_message (sender_id, recipient_id, created_at)"),
+        ("ix_playlistvideo_playlist_pos", "CREATE INDEX ix_playlistvideo_playlist_pos ON playlist_video (playlist_id, position)"),
+        ("ix_musicqueue_channel_played_pos", "CREATE INDEX ix_musicqueue_channel_played_pos ON music_queue (channel_id, is_played, position)"),
+        ("ix_friendship_pair_status", "CREATE INDEX ix_friendship_pair_status ON friendship (user_id, friend_id, status)"),
+        ("ix_friendship_friend_status", "CREATE INDEX ix_friendship_friend_status ON friendship (friend_id, status)"),
+        ("uq_videolike_user_video", "CREATE UNIQUE INDEX uq_videolike_user_video ON video_like (user_id, video_id)"),
+        ("uq_watchlater_user_video", "CREATE UNIQUE INDEX uq_watchlater_user_video ON watch_later (user_id, video_id)"),
+        ("uq_subscription_pair", "CREATE UNIQUE INDEX uq_subscription_pair ON subscription (subscriber_id, subscribed_to_id)"),
+        ("uq_playlistvideo_playlist_video", "CREATE UNIQUE INDEX uq_playlistvideo_playlist_video ON playlist_video (playlist_id, video_id)"),
+        ("uq_voiceparticipant_user", "CREATE UNIQUE INDEX uq_voiceparticipant_user ON voice_participant (user_id)"),
+    ]
+    # Unique indexes can't be built over existing duplicates; keep the oldest row of each
+    dedupe = {
+        "uq_videolike_user_video": "DELETE FROM video_like WHERE id NOT IN (SELECT MIN(id) FROM video_like GROUP BY user_id, video_id)",
+        "uq_watchlater_user_video": "DELETE FROM watch_later WHERE id NOT IN (SELECT MIN(id) FROM watch_later GROUP BY user_id, video_id)",
+        "uq_subscription_pair": "DELETE FROM subscription WHERE id NOT IN (SELECT MIN(id) FROM subscription GROUP BY subscriber_id, subscribed_to_id)",
+        "uq_playlistvideo_playlist_video": "DELETE FROM playlist_video WHERE id NOT IN (SELECT MIN(id) FROM playlist_video GROUP BY playlist_id, video_id)",
+        # Image emoji (NULL emoji_char) never collide and are left alone
+        "uq_emoji_cat": "DELETE FROM custom_emoji WHERE emoji_char IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM custom_emoji GROUP BY emoji_char, category)",
+        # Latest join wins for voice participation
+        "uq_voiceparticipant_user": "DELETE FROM voice_participant WHERE id NOT IN (SELECT MAX(id) FROM voice_participant GROUP BY user_id)",
+    }
+    for index_name, sql in indexes:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (index_name,))
+        if not cursor.fetchone():
+            if index_name in dedupe:
+                migrations.append((f"Dedupe before {index_name}", dedupe[index_name]))
+            migrations.append((f"Index {index_name}", sql))
+    
     # Execute migrations
     if migrations:
         print(f"📝 Found {len(migrations)} migration(s) to apply:")
@@ -1,10 +1,27 @@
 import os
+import re
+import secrets
+import hashlib
+import hmac
 from datetime import datetime
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from flask_sqlalchemy import SQLAlchemy
 
 # single shared SQLAlchemy object for the app to initialize
 db = SQLAlchemy()
 
+# Search uses ILIKE '%q%'; on PostgreSQL trigram GIN indexes let that use an index.
+# They need the pg_trgm extension, which a restricted database role may not be allowed
+# to install, so they stay out of create_all() and are built separately (table, column).
+TRGM_INDEXES = {
+    "ix_user_username_trgm": ("user", "username"),
+    "ix_user_display_trgm": ("user", "display"),
+    "ix_server_name_trgm": ("server", "name"),
+    "ix_video_title_trgm": ("video", "title"),
+    "ix_video_description_trgm": ("video", "description"),
+}
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -24,7 +41,7 @@ class Server(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     slug = db.Column(db.String(140), unique=True, nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"))
     server_icon = db.Column(db.String(255))  # Path to custom server icon image
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -41,7 +58,7 @@ class Channel(db.Model):
 
 class Membership(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     server_id = db.Column(db.Integer, db.ForeignKey("server.id"))
 
 
@@ -66,7 +83,7 @@ class Role(db.Model):
 class RoleMembership(db.Model):
     """Links users to roles within a server"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     role_id = db.Column(db.Integer, db.ForeignKey("role.id"), nullable=False)
     assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -77,19 +94,29 @@ class Video(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     thumbnail = db.Column(db.String(255))
     description = db.Column(db.Text)
-    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     view_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_video_uploader_created", "uploader_id", "created_at"),
+        db.Index("ix_video_created", "created_at"),
+    )
+
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     server_id = db.Column(db.Integer, db.ForeignKey("server.id"))
     channel_id = db.Column(db.Integer, db.ForeignKey("channel.id"))
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     content = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_message_channel_created", "channel_id", "created_at"),
+        db.Index("ix_message_created", "created_at"),
+    )
+
 
 class Sponsor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -109,85 +136,131 @@ class Activity(db.Model):
 class Playlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class PlaylistVideo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    playlist_id = db.Column(db.Integer, db.ForeignKey("playlist.id"))
-    video_id = db.Column(db.Integer, db.ForeignKey("video.id"))
+    playlist_id = db.Column(db.Integer, db.ForeignKey("playlist.id", ondelete="CASCADE"))
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id", ondelete="CASCADE"))
     position = db.Column(db.Integer)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_playlistvideo_playlist_pos", "playlist_id", "position"),
+        db.Index("uq_playlistvideo_playlist_video", "playlist_id", "video_id", unique=True),
+    )
+
 
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    subscriber_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    subscribed_to_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    subscriber_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    subscribed_to_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Leading subscriber_id also serves "who do I follow" lookups
+        db.Index("uq_subscription_pair", "subscriber_id", "subscribed_to_id", unique=True),
+    )
+
 
 class VideoLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    video_id = db.Column(db.Integer, db.ForeignKey("video.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id", ondelete="CASCADE"))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_videolike_video", "video_id"),
+        db.Index("ix_videolike_user_created", "user_id", "created_at"),
+        db.Index("uq_videolike_user_video", "user_id", "video_id", unique=True),
+    )
+
 
 class WatchLater(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    video_id = db.Column(db.Integer, db.ForeignKey("video.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id", ondelete="CASCADE"))
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_watchlater_user_added", "user_id", "added_at"),
+        db.Index("uq_watchlater_user_video", "user_id", "video_id", unique=True),
+    )
+
 
 class Short(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     thumbnail = db.Column(db.String(255))
-    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    uploader_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_short_created", "created_at"),
+    )
+
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     message = db.Column(db.String(255), nullable=False)
     link = db.Column(db.String(255))  # Optional link to related content
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_notification_user_read", "user_id", "is_read"),
+    )
+
 
 class VoiceParticipant(db.Model):
     """Tracks users currently in voice channels"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey("channel.id"), nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_muted = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index("ix_voiceparticipant_channel", "channel_id"),
+        # One voice channel per user at a time; join_voice upserts on this
+        db.Index("uq_voiceparticipant_user", "user_id", unique=True),
+    )
+
 
 class Friendship(db.Model):
     """Tracks friend relationships between users"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    friend_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    friend_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     status = db.Column(db.String(20), default="pending")  # pending, accepted, blocked
     requested_at = db.Column(db.DateTime, default=datetime.utcnow)
     accepted_at = db.Column(db.DateTime)
 
+    __table_args__ = (
+        # Friendships are looked up from either side
+        db.Index("ix_friendship_pair_status", "user_id", "friend_id", "status"),
+        db.Index("ix_friendship_friend_status", "friend_id", "status"),
+    )
+
 
 class DirectMessage(db.Model):
     """Direct messages between friends"""
     id = db.Column(db.Integer, primary_key=True)
-    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     content = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_dm_recipient_read", "recipient_id", "is_read"),
+        db.Index("ix_dm_pair_created", "sender_id", "recipient_id", "created_at"),
+    )
+
 
 class RtcSignal(db.Model):
     """Lightweight signaling messages for WebRTC using HTTP polling.
@@ -195,18 +268,22 @@ class RtcSignal(db.Model):
     """
     id = db.Column(db.Integer, primary_key=True)
     room = db.Column(db.String(120), index=True, nullable=False)
-    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    target_id = db.Column(db.Integer, db.ForeignKey("user.id"))  # null for broadcast
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    target_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))  # null for broadcast
     kind = db.Column(db.String(20), nullable=False)  # offer, answer, candidate, join, leave
     payload = db.Column(db.Text, nullable=False)  # JSON string
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
+    __table_args__ = (
+        db.Index("ix_rtc_poll_room_id", "room", "id"),
+    )
+
 
 class RtcParticipant(db.Model):
     """Tracks room participants to coordinate peers without websockets."""
     id = db.Column(db.Integer, primary_key=True)
     room = db.Column(db.String(120), index=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
@@ -214,11 +291,13 @@ class RtcParticipant(db.Model):
 class VideoComment(db.Model):
     """Comments on videos with emoji support"""
     id = db.Column(db.Integer, primary_key=True)
-    video_id = db.Column(db.Integer, db.ForeignKey("video.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
+    user = db.relationship("User", lazy="joined")
+
 
 class CustomEmoji(db.Model):
     """Custom emojis managed by admins"""
@@ -232,6 +311,11 @@ class CustomEmoji(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # NULL emoji_char (image emojis) never conflicts
+        db.Index("uq_emoji_cat", "emoji_char", "category", unique=True),
+    )
+
 
 class Advertisement(db.Model):
     """Small ads displayed throughout the site"""
@@ -267,22 +351,52 @@ class MusicQueue(db.Model):
     """Queue of songs for music bot"""
     id = db.Column(db.Integer, primary_key=True)
     channel_id = db.Column(db.Integer, db.ForeignKey("channel.id"), nullable=False)
-    added_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    added_by = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     song_url = db.Column(db.String(500), nullable=False)
     song_title = db.Column(db.String(200))
     position = db.Column(db.Integer, default=0)
     is_played = db.Column(db.Boolean, default=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_musicqueue_channel_played_pos", "channel_id", "is_played", "position"),
+    )
+
+
+# Argon2id hasher used for all stored passwords (OWASP baseline: 19 MiB, t=2, p=1).
+# Hashes made with other parameters are re-hashed on the next successful login.
+PH = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 
 def hash_pw(pw: str) -> str:
-    import hashlib
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    return PH.hash(pw)
+
+
+def check_pw(password_hash: str, pw: str) -> bool:
+    """Verify a password against an argon2 hash or a legacy unsalted SHA-256 hex digest."""
+    if not password_hash:
+        return False
+    if password_hash.startswith("$argon2"):
+        try:
+            return PH.verify(password_hash, pw)
+        except (VerificationError, InvalidHashError):
+            return False
+    legacy = hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    return hmac.compare_digest(password_hash, legacy)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True for legacy SHA-256 hashes and argon2 hashes made with outdated parameters."""
+    if not password_hash.startswith("$argon2"):
+        return True
+    return PH.check_needs_rehash(password_hash)
+
+
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
 
 
 def safe_slug(name: str) -> str:
-    import re, secrets
-    s = re.sub(r"[^a-zA-Z0-9]+", "-", name.lower()).strip("-")
+    s = _SLUG_RE.sub("-", name.lower()).strip("-")
     if not s:
         s = secrets.token_hex(3)
     return s
@@ -291,16 +405,18 @@ def safe_slug(name: str) -> str:
 class EmailVerification(db.Model):
     """Tracks email verification state for users without altering the User schema."""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), unique=True, nullable=False)
     verified_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     content_raw = db.Column(db.Text, nullable=False)
     content_html = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    author = db.relationship("User", lazy="joined")
@@ -0,0 +1,77 @@
+import os
+import tempfile
+
+import pytest
+
+# app.py reads these at import time
+_DB_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("SMTP_HOST", None)
+
+import app as cannaspot  # noqa: E402
+from models import db, User, hash_pw  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    flask_app = cannaspot.app
+    flask_app.config["TESTING"] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Re-detected per test, since some tests drop indexes to mimic older databases
+        flask_app.config.pop("_UNIQUE_INDEXES", None)
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def drop_index(app):
+    """Make the test database look like one created before an index existed."""
+    def drop(name):
+        db.session.execute(db.text(f"DROP INDEX {name}"))
+        db.session.commit()
+        app.config.pop("_UNIQUE_INDEXES", None)
+    return drop
+
+
+@pytest.fixture
+def redis(request, monkeypatch):
+    """A fakeredis client installed as app.redis_client.
+
+    A stand-in Celery app is installed too, so the Redis buffers are used as in a deploy
+    with a worker; mark a test @pytest.mark.redis(celery=False) for Redis without one.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    marker = request.node.get_closest_marker("redis")
+    celery = marker.kwargs.get("celery", True) if marker else True
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(cannaspot, "redis_client", r)
+    monkeypatch.setattr(cannaspot, "celery_app", object() if celery else None)
+    cannaspot._unread_cache.clear()
+    yield r
+    cannaspot._unread_cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    def make(username="alice", password="secret1"):
+        u = User(username=username, email=f"{username}@example.com", password_hash=hash_pw(password))
+        db.session.add(u)
+        db.session.commit()
+        return u
+    return make
+
+
+@pytest.fixture
+def login(client):
+    def do_login(username="alice", password="secret1"):
+        r = client.post("/login", data={"username": username, "password": password})
+        assert r.status_code == 302, r.data[:200]
+    return do_login
@@ -0,0 +1,26 @@
+import hashlib
+
+from models import db, User
+
+
+def test_login_upgrades_legacy_sha256_hash(client, app):
+    legacy = hashlib.sha256(b"secret1").hexdigest()
+    db.session.add(User(username="old", email="old@example.com", password_hash=legacy))
+    db.session.commit()
+
+    r = client.post("/login", data={"username": "old", "password": "secret1"})
+    assert r.status_code == 302
+
+    db.session.expire_all()
+    upgraded = User.query.filter_by(username="old").one().password_hash
+    assert upgraded.startswith("$argon2id$")
+    client.get("/logout")
+    assert client.post("/login", data={"username": "old", "password": "secret1"}).status_code == 302
+
+
+def test_login_rejects_wrong_password(client, make_user):
+    make_user("alice")
+    r = client.post("/login", data={"username": "alice", "password": "nope"})
+    assert r.status_code == 200
+    with client.session_transaction() as sess:
+        assert "uid" not in sess
@@ -0,0 +1,42 @@
+import re
+from urllib.parse import urlsplit
+
+import pytest
+
+import app as cannaspot
+from models import db, EmailVerification, User
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    sent = []
+    monkeypatch.setattr(cannaspot, "SMTP_HOST", "smtp.test")
+    monkeypatch.setattr(cannaspot, "send_email", lambda **msg: sent.append(msg))
+    return sent
+
+
+def _register(client):
+    r = client.post("/register", data={"username": "newbie", "email": "newbie@example.com", "password": "secret1"})
+    assert r.status_code == 302
+    return User.query.filter_by(username="newbie").one()
+
+
+def test_signup_sends_one_welcome_and_verify_email(client, outbox):
+    user = _register(client)
+    assert len(outbox) == 1 and outbox[0]["to"] == "newbie@example.com"
+    pending = EmailVerification.query.filter_by(user_id=user.id).one()
+    assert pending.verified_at is None
+
+
+def test_verify_link_marks_the_email_verified(client, outbox):
+    user = _register(client)
+    link = re.search(r"https?://\S+/verify-email/[\w.\-]+", outbox[0]["text_body"]).group(0)
+    assert client.get(urlsplit(link).path).status_code == 302
+    db.session.expire_all()
+    assert EmailVerification.query.filter_by(user_id=user.id).one().verified_at is not None
+
+
+def test_bad_token_is_rejected(client, outbox):
+    user = _register(client)
+    assert client.get("/verify-email/not-a-token").status_code == 302
+    assert EmailVerification.query.filter_by(user_id=user.id).one().verified_at is None
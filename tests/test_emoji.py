@@ -0,0 +1,64 @@
+import pytest
+
+import app as cannaspot
+from models import db, CustomEmoji
+
+
+@pytest.fixture
+def admin_client(client, make_user, login):
+    admin = make_user("admin")
+    admin.is_admin = True
+    db.session.commit()
+    login("admin")
+    return client
+
+
+def _add(client, char):
+    r = client.post("/theGspot", data={"action": "add_emoji", "emoji_category": "plants", "emoji_char": char})
+    assert r.status_code in (200, 302), r.data[:200]
+
+
+def test_duplicate_emoji_is_rejected(admin_client):
+    _add(admin_client, "🌿")
+    _add(admin_client, "🌿")
+    assert CustomEmoji.query.count() == 1
+
+
+def test_duplicate_emoji_rejected_without_unique_index(admin_client, drop_index):
+    drop_index("uq_emoji_cat")
+    _add(admin_client, "🌿")
+    _add(admin_client, "🌿")
+    assert CustomEmoji.query.count() == 1
+
+
+def test_boot_dedupe_keeps_image_only_emojis(app, drop_index):
+    drop_index("uq_emoji_cat")
+    db.session.add_all([
+        CustomEmoji(category="plants", emoji_char="🌿"),
+        CustomEmoji(category="plants", emoji_char="🌿"),
+        CustomEmoji(category="plants", emoji_char=None, image_path="emojis/a.png"),
+        CustomEmoji(category="plants", emoji_char=None, image_path="emojis/b.png"),
+    ])
+    db.session.commit()
+
+    assert "uq_emoji_cat" in cannaspot._ensure_unique_indexes()
+    assert CustomEmoji.query.filter_by(emoji_char="🌿").count() == 1
+    assert CustomEmoji.query.filter(CustomEmoji.emoji_char.is_(None)).count() == 2
+
+
+def test_migration_dedupes_before_building_uq_emoji_cat(app, drop_index, monkeypatch):
+    import migrate_db
+    drop_index("uq_emoji_cat")
+    db.session.add_all([
+        CustomEmoji(category="plants", emoji_char="🌿"),
+        CustomEmoji(category="plants", emoji_char="🌿"),
+        CustomEmoji(category="plants", emoji_char=None, image_path="emojis/a.png"),
+        CustomEmoji(category="plants", emoji_char=None, image_path="emojis/b.png"),
+    ])
+    db.session.commit()
+
+    monkeypatch.setattr(migrate_db, "DB_PATH", db.engine.url.database)
+    migrate_db.migrate()
+    assert "uq_emoji_cat" in {ix["name"] for ix in db.inspect(db.engine).get_indexes("custom_emoji")}
+    assert CustomEmoji.query.filter_by(emoji_char="🌿").count() == 1
+    assert CustomEmoji.query.filter(CustomEmoji.emoji_char.is_(None)).count() == 2
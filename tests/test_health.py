@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
+
+import app as cannaspot
+from models import db
+
+
+@pytest.fixture
+def health(app, monkeypatch):
+    monkeypatch.setattr(cannaspot, "_health_cached", None)
+    monkeypatch.setattr(cannaspot, "_health_future", None)
+    monkeypatch.setattr(cannaspot, "_health_engine", None)
+    yield
+    if cannaspot._health_engine is not None:
+        cannaspot._health_engine.dispose()
+
+
+def test_probe_uses_its_own_unpooled_engine(client, health):
+    r = client.get("/health")
+    assert r.status_code == 200 and r.json["database"] == "healthy"
+    engine = cannaspot._health_engine
+    assert isinstance(engine.pool, NullPool)
+    assert engine is not db.engine and engine.url == db.engine.url
+
+
+def test_probe_leaves_the_app_pool_alone(client, health):
+    checkouts = []
+    listener = lambda *_: checkouts.append(1)
+    event.listen(db.engine, "checkout", listener)
+    try:
+        assert client.get("/health").status_code == 200
+    finally:
+        event.remove(db.engine, "checkout", listener)
+    assert checkouts == []
+
+
+def test_failed_probe_answers_503(client, health, monkeypatch):
+    def down(engine):
+        raise RuntimeError("connection refused")
+    monkeypatch.setattr(cannaspot, "_probe_db", down)
+    r = client.get("/health")
+    assert r.status_code == 503
+    assert r.json["status"] == "degraded"
+    assert r.json["database"] == "unhealthy: connection refused"
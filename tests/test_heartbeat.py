@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import event
+
+import app as cannaspot
+from models import db, User
+
+
+@pytest.fixture
+def user_writes(app):
+    """UPDATE statements against the user table issued while the test runs."""
+    seen = []
+
+    def record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith(('UPDATE "USER"', "UPDATE USER")):
+            seen.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield seen
+    event.remove(db.engine, "before_cursor_execute", record)
+
+
+def _status(user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).status
+
+
+def test_heartbeats_skip_the_database_once_status_is_cached(client, make_user, login, redis, user_writes):
+    alice = make_user("alice")
+    login("alice")
+    client.post("/api/status/heartbeat")
+    user_writes.clear()
+    for _ in range(5):
+        assert client.post("/api/status/heartbeat").status_code == 200
+    assert user_writes == []
+    assert redis.hget(cannaspot.LAST_SEEN_KEY, alice.id) is not None
+
+
+def test_heartbeat_brings_user_back_from_offline(client, make_user, login, redis):
+    alice = make_user("alice")
+    login("alice")
+    client.post("/api/status/heartbeat")
+    assert client.post("/api/status/update", json={"status": "offline"}).status_code == 200
+    assert _status(alice.id) == "offline"
+    client.post("/api/status/heartbeat")
+    assert _status(alice.id) == "online"
+
+
+def test_flush_never_moves_last_seen_backwards(app, redis, make_user):
+    newer, stale = make_user("newer"), make_user("stale")
+    newer.last_seen = datetime(2030, 1, 1)
+    stale.last_seen = datetime(2000, 1, 1)
+    db.session.commit()
+    ts = int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp())
+    redis.hset(cannaspot.LAST_SEEN_KEY, mapping={newer.id: ts, stale.id: ts})
+
+    assert cannaspot.flush_last_seen() == 2
+    db.session.expire_all()
+    assert db.session.get(User, newer.id).last_seen == datetime(2030, 1, 1)
+    assert db.session.get(User, stale.id).last_seen == datetime(2020, 1, 1)
@@ -0,0 +1,71 @@
+import app as cannaspot
+from models import db, Advertisement, Server, Video, VideoLike
+
+
+def _etag(client, **headers):
+    r = client.get("/", headers=headers)
+    assert r.status_code in (200, 304), r.status_code
+    return r
+
+
+def test_repeat_visit_gets_304(client, make_user):
+    make_user("alice")
+    etag = _etag(client).headers["ETag"]
+    assert _etag(client, **{"If-None-Match": etag}).status_code == 304
+
+
+def test_new_video_changes_etag(client, make_user):
+    alice = make_user("alice")
+    etag = _etag(client).headers["ETag"]
+    db.session.add(Video(title="new", filename="/uploads/videos/n.mp4", uploader_id=alice.id))
+    db.session.commit()
+    assert _etag(client, **{"If-None-Match": etag}).status_code == 200
+
+
+def test_removed_like_and_video_change_etag(client, make_user):
+    alice = make_user("alice")
+    old, new = (Video(title=t, filename=f"/uploads/videos/{t}.mp4", uploader_id=alice.id) for t in ("old", "new"))
+    db.session.add_all([old, new])
+    db.session.flush()
+    first = VideoLike(user_id=alice.id, video_id=old.id)
+    db.session.add_all([first, VideoLike(user_id=alice.id, video_id=new.id)])
+    db.session.commit()
+    etag = _etag(client).headers["ETag"]
+
+    # Neither removal moves a MAX probe
+    db.session.delete(first)
+    db.session.commit()
+    unliked = _etag(client, **{"If-None-Match": etag})
+    assert unliked.status_code == 200
+
+    db.session.delete(old)
+    db.session.commit()
+    assert _etag(client, **{"If-None-Match": unliked.headers["ETag"]}).status_code == 200
+
+
+def test_ad_and_server_changes_change_etag(client, make_user):
+    alice = make_user("alice")
+    server = Server(name="Old", slug="old", owner_id=alice.id)
+    db.session.add(server)
+    db.session.commit()
+    cannaspot.clear_globals_cache()
+    etag = _etag(client).headers["ETag"]
+
+    server.name = "Renamed"
+    db.session.commit()
+    cannaspot.clear_globals_cache()
+    renamed = _etag(client, **{"If-None-Match": etag})
+    assert renamed.status_code == 200
+
+    db.session.add(Advertisement(title="ad", placement="sidebar", is_active=True))
+    db.session.commit()
+    cannaspot.clear_globals_cache()
+    assert _etag(client, **{"If-None-Match": renamed.headers["ETag"]}).status_code == 200
+
+
+def test_ad_token_window_rolls_etag(client, make_user, monkeypatch):
+    make_user("alice")
+    etag = _etag(client).headers["ETag"]
+    now = cannaspot.time.time()
+    monkeypatch.setattr(cannaspot.time, "time", lambda: now + cannaspot.AD_TOKEN_WINDOW)
+    assert _etag(client, **{"If-None-Match": etag}).status_code == 200
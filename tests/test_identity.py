@@ -0,0 +1,88 @@
+from models import db, User, Video, VideoLike, VoiceParticipant, Server, Channel, Post
+
+
+def _delete(user_id):
+    db.session.query(User).filter_by(id=user_id).delete()
+    db.session.commit()
+    db.session.expire_all()
+
+
+def test_deleted_user_cannot_like(client, make_user, login):
+    owner = make_user("owner")
+    video = Video(title="v", filename="/uploads/videos/v.mp4", uploader_id=owner.id)
+    db.session.add(video)
+    ghost = make_user("ghost")
+    db.session.commit()
+    login("ghost")
+    _delete(ghost.id)
+
+    r = client.post(f"/api/like/{video.id}")
+    assert r.status_code == 401
+    assert VideoLike.query.count() == 0
+    with client.session_transaction() as sess:
+        assert "uid" not in sess
+
+
+def test_deleted_user_cannot_join_voice(client, make_user, login):
+    owner = make_user("owner")
+    server = Server(name="S", slug="s", owner_id=owner.id)
+    db.session.add(server)
+    db.session.flush()
+    channel = Channel(server_id=server.id, name="voice", is_voice=True)
+    db.session.add(channel)
+    ghost = make_user("ghost")
+    db.session.commit()
+    login("ghost")
+    _delete(ghost.id)
+
+    assert client.post(f"/api/voice/join/{channel.id}").status_code == 401
+    assert VoiceParticipant.query.count() == 0
+
+
+def test_deleted_user_form_post_redirects_to_login(client, make_user, login):
+    ghost = make_user("ghost")
+    login("ghost")
+    _delete(ghost.id)
+
+    r = client.post("/create-server", data={"name": "Nope"})
+    assert r.status_code == 302 and "/login" in r.location
+    assert Server.query.count() == 0
+
+
+def test_live_user_can_still_post(client, make_user, login):
+    make_user("alice")
+    login("alice")
+    r = client.post("/create-server", data={"name": "Mine"})
+    assert r.status_code == 302
+    assert Server.query.filter_by(name="Mine").count() == 1
+
+
+def _post(owner):
+    p = Post(user_id=owner.id, title="t", content_raw="c", content_html="c")
+    db.session.add(p)
+    db.session.commit()
+    return p.id
+
+
+def test_demoted_admin_cannot_edit_or_delete_others_posts(client, make_user, login):
+    pid = _post(make_user("author"))
+    admin = make_user("admin")
+    admin.is_admin = True
+    db.session.commit()
+    login("admin")
+    assert client.get(f"/post/{pid}/edit").status_code == 200
+
+    # The cookie still says admin; the row doesn't
+    admin.is_admin = False
+    db.session.commit()
+    assert client.get(f"/post/{pid}/edit").status_code == 403
+    assert client.post(f"/post/{pid}/delete").status_code == 403
+    assert db.session.get(Post, pid) is not None
+
+
+def test_deleted_user_gets_403_not_500_on_edit_page(client, make_user, login):
+    pid = _post(make_user("author"))
+    ghost = make_user("ghost")
+    login("ghost")
+    _delete(ghost.id)
+    assert client.get(f"/post/{pid}/edit").status_code == 403
@@ -0,0 +1,26 @@
+import app as cannaspot
+from models import db, Notification
+
+
+def test_notifications_are_queued_then_flushed(redis, make_user):
+    bob = make_user("bob")
+    cannaspot.add_notification(bob.id, "hello", "/x")
+    db.session.commit()
+    assert Notification.query.count() == 0
+    assert redis.llen(cannaspot.NOTIF_QUEUE_KEY) == 1
+
+    assert cannaspot.flush_notifications() == 1
+    n = Notification.query.one()
+    assert (n.user_id, n.message, n.link) == (bob.id, "hello", "/x")
+    assert redis.llen(cannaspot.NOTIF_QUEUE_KEY) == 0
+
+
+def test_flush_skips_deleted_users(redis, make_user):
+    bob, gone = make_user("bob"), make_user("gone")
+    cannaspot.add_notification(bob.id, "kept")
+    cannaspot.add_notification(gone.id, "dropped")
+    db.session.delete(gone)
+    db.session.commit()
+
+    assert cannaspot.flush_notifications() == 1
+    assert [n.message for n in Notification.query.all()] == ["kept"]
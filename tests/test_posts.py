@@ -0,0 +1,8 @@
+import app as cannaspot
+
+
+def test_post_html_links_urls_and_escapes_the_rest():
+    out = cannaspot._render_post_html('see https://example.com/a?b=1 <script>x</script>\nbye')
+    assert '<a href="https://example.com/a?b=1" target="_blank" rel="nofollow noopener">' in out
+    assert "&lt;script&gt;" in out and "<script>" not in out
+    assert out.endswith("<br>bye")
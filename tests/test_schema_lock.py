@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+import app as cannaspot
+from models import db
+
+pytestmark = pytest.mark.skipif(cannaspot.fcntl is None, reason="needs fcntl")
+
+
+@pytest.fixture
+def create_all_calls(app, tmp_path, monkeypatch):
+    calls = []
+    real = db.create_all
+    monkeypatch.setattr(db, "create_all", lambda: calls.append(1) or real())
+    monkeypatch.setattr(cannaspot.tempfile, "gettempdir", lambda: str(tmp_path))
+    # The lock only coordinates networked databases
+    monkeypatch.setattr(cannaspot, "database_url", "postgresql://db.example/cannaspot")
+    return calls
+
+
+def test_second_boot_within_window_skips_create_all(create_all_calls):
+    cannaspot._create_tables_once()
+    cannaspot._create_tables_once()
+    assert len(create_all_calls) == 1
+
+
+def test_stale_marker_runs_create_all_again(create_all_calls, tmp_path):
+    cannaspot._create_tables_once()
+    marker = next(tmp_path.glob("cannaspot-schema-*.ready"))
+    old = marker.stat().st_mtime - cannaspot.SCHEMA_READY_WINDOW - 1
+    os.utime(marker, (old, old))
+    cannaspot._create_tables_once()
+    assert len(create_all_calls) == 2
+
+
+def test_sqlite_is_not_coordinated(create_all_calls, monkeypatch, tmp_path):
+    monkeypatch.setattr(cannaspot, "database_url", "sqlite:///x.db")
+    cannaspot._create_tables_once()
+    cannaspot._create_tables_once()
+    assert len(create_all_calls) == 2
+    assert not list(tmp_path.glob("cannaspot-schema-*"))
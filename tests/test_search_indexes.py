@@ -0,0 +1,16 @@
+from sqlalchemy import create_mock_engine
+
+from models import db, TRGM_INDEXES
+
+
+def test_create_all_never_needs_pg_trgm():
+    ddl = []
+    engine = create_mock_engine("postgresql://", lambda sql, *a, **kw: ddl.append(str(sql.compile(dialect=engine.dialect))))
+    db.metadata.create_all(engine, checkfirst=False)
+    assert ddl
+    assert not [s for s in ddl if "trgm" in s or "gin" in s.lower().split()]
+
+
+def test_trigram_indexes_name_real_columns():
+    for name, (table, column) in TRGM_INDEXES.items():
+        assert column in db.metadata.tables[table].c, name
@@ -0,0 +1,53 @@
+from sqlalchemy import inspect
+
+import app as cannaspot
+from models import db, Video, VideoLike, Subscription
+
+
+def _video(owner):
+    v = Video(title="v", filename="/uploads/videos/v.mp4", uploader_id=owner.id)
+    db.session.add(v)
+    db.session.commit()
+    return v
+
+
+def test_like_is_idempotent(client, make_user, login):
+    v = _video(make_user("alice"))
+    login("alice")
+    for _ in range(2):
+        assert client.post(f"/api/like/{v.id}").status_code == 200
+    assert VideoLike.query.count() == 1
+
+
+def test_like_without_unique_index_checks_first(client, make_user, login, drop_index):
+    drop_index("uq_videolike_user_video")
+    v = _video(make_user("alice"))
+    login("alice")
+    for _ in range(3):
+        assert client.post(f"/api/like/{v.id}").status_code == 200
+    assert VideoLike.query.count() == 1
+
+
+def test_subscribe_without_unique_index_checks_first(client, make_user, login, drop_index):
+    drop_index("uq_subscription_pair")
+    make_user("alice")
+    bob = make_user("bob")
+    login("alice")
+    for _ in range(2):
+        assert client.post(f"/api/subscribe/{bob.id}").status_code == 200
+    assert Subscription.query.count() == 1
+
+
+def test_boot_creates_missing_unique_index_after_dedupe(make_user, drop_index):
+    drop_index("uq_videolike_user_video")
+    alice = make_user("alice")
+    v = _video(alice)
+    db.session.add_all([VideoLike(user_id=alice.id, video_id=v.id) for _ in range(3)])
+    db.session.commit()
+    first_id = min(like.id for like in VideoLike.query)
+
+    assert "uq_videolike_user_video" in cannaspot._ensure_unique_indexes()
+
+    names = {ix["name"] for ix in inspect(db.engine).get_indexes("video_like")}
+    assert "uq_videolike_user_video" in names
+    assert [like.id for like in VideoLike.query] == [first_id]
@@ -0,0 +1,27 @@
+import app as cannaspot
+
+
+def test_count_is_cached_until_a_write_forgets_it(app, redis):
+    rows = [1, 2]
+    assert cannaspot.unread_count(cannaspot.NOTIF_UNREAD_KEY, 7, lambda: len(rows)) == 2
+    assert int(redis.get("notif:unread:7")) == 2
+
+    rows.append(3)
+    cannaspot.forget_unread(cannaspot.NOTIF_UNREAD_KEY, 7)
+    assert cannaspot.unread_count(cannaspot.NOTIF_UNREAD_KEY, 7, lambda: len(rows)) == 3
+
+
+def test_write_during_count_is_not_overwritten(app, redis):
+    rows = [1, 2]
+
+    def count_then_write():
+        counted = len(rows)
+        # Another request commits a new row and clears the counter while this one counts
+        rows.append(3)
+        cannaspot.forget_unread(cannaspot.NOTIF_UNREAD_KEY, 7)
+        return counted
+
+    assert cannaspot.unread_count(cannaspot.NOTIF_UNREAD_KEY, 7, count_then_write) == 2
+    assert redis.get("notif:unread:7") is None
+    cannaspot._unread_cache.clear()
+    assert cannaspot.unread_count(cannaspot.NOTIF_UNREAD_KEY, 7, lambda: len(rows)) == 3
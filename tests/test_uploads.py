@@ -0,0 +1,56 @@
+import io
+
+import pytest
+
+import app as cannaspot
+from models import db, Video
+
+
+@pytest.fixture
+def admin_client(client, make_user, login, tmp_path, monkeypatch):
+    # Video.filename is a URL path ("/uploads/videos/...") resolved against BASE_DIR
+    video_dir = tmp_path / "uploads" / "videos"
+    video_dir.mkdir(parents=True)
+    monkeypatch.setattr(cannaspot, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(cannaspot, "VIDEO_DIR", str(video_dir))
+    admin = make_user("admin")
+    admin.is_admin = True
+    db.session.commit()
+    login("admin")
+    return client
+
+
+def _upload(client, data=b"same bytes"):
+    r = client.post("/upload", data={"title": "t", "video": (io.BytesIO(data), "clip.mp4")},
+                    content_type="multipart/form-data")
+    assert r.status_code == 302, r.data[:200]
+    return Video.query.order_by(Video.id.desc()).first()
+
+
+def _delete(client, video_id):
+    r = client.post("/theGspot", data={"action": "delete_video", "video_id": video_id})
+    assert r.status_code in (200, 302)
+
+
+def test_identical_uploads_share_a_file_until_the_last_delete(admin_client, tmp_path):
+    first, second = _upload(admin_client), _upload(admin_client)
+    assert first.filename == second.filename
+    stored = tmp_path / first.filename.lstrip("/")
+    assert stored.exists()
+    first_id, second_id = first.id, second.id
+
+    _delete(admin_client, first_id)
+    assert stored.exists()
+    _delete(admin_client, second_id)
+    assert not stored.exists()
+
+
+def test_random_naming_keeps_identical_uploads_apart(tmp_path):
+    from werkzeug.datastructures import FileStorage
+
+    def upload():
+        return FileStorage(io.BytesIO(b"same bytes"), filename="../icon.png")
+    names = {cannaspot.write_upload(upload(), str(tmp_path), cannaspot.random_upload_name("ad_", 4)) for _ in range(2)}
+    assert len(names) == 2
+    assert all(n.startswith("ad_") and n.endswith("_icon.png") for n in names)
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(names)
@@ -0,0 +1,33 @@
+import pytest
+
+import app as cannaspot
+from models import db, Video
+
+
+@pytest.fixture
+def video(make_user):
+    v = Video(title="v", filename="/uploads/videos/v.mp4", uploader_id=make_user("alice").id)
+    db.session.add(v)
+    db.session.commit()
+    return v
+
+
+def _views(video_id):
+    db.session.expire_all()
+    return db.session.get(Video, video_id).view_count or 0
+
+
+@pytest.mark.redis(celery=False)
+def test_redis_without_celery_writes_views_directly(app, video, redis):
+    cannaspot.record_view(video.id)
+    assert _views(video.id) == 1
+    assert redis.get(cannaspot.VIEW_KEY.format(video.id)) is None
+
+
+def test_buffered_views_reach_the_database_on_flush(app, video, redis):
+    for _ in range(3):
+        cannaspot.record_view(video.id)
+    assert _views(video.id) == 0
+    assert cannaspot.pending_views(video.id) == 3
+    assert cannaspot.flush_view_counts() == 1
+    assert _views(video.id) == 3
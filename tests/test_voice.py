@@ -0,0 +1,32 @@
+from models import db, Server, Channel, VoiceParticipant
+
+
+def _voice_channels(owner, n=2):
+    server = Server(name="S", slug="s", owner_id=owner.id)
+    db.session.add(server)
+    db.session.flush()
+    channels = [Channel(server_id=server.id, name=f"voice{i}", is_voice=True) for i in range(n)]
+    db.session.add_all(channels)
+    db.session.commit()
+    return channels
+
+
+def _join_both(client, channels):
+    for ch in channels:
+        r = client.post(f"/api/voice/join/{ch.id}")
+        assert r.status_code == 200, r.data[:200]
+
+
+def test_join_voice_moves_participation(client, make_user, login):
+    channels = _voice_channels(make_user("alice"))
+    login("alice")
+    _join_both(client, channels)
+    assert [p.channel_id for p in VoiceParticipant.query] == [channels[1].id]
+
+
+def test_join_voice_without_unique_index(client, make_user, login, drop_index):
+    drop_index("uq_voiceparticipant_user")
+    channels = _voice_channels(make_user("alice"))
+    login("alice")
+    _join_both(client, channels)
+    assert [p.channel_id for p in VoiceParticipant.query] == [channels[1].id]
@@ -4,23 +4,25 @@ import os
 # Add application directory to Python path
 sys.path.insert(0, os.path.dirname(__file__))
 
-# Activate virtual environment if it exists
-venv_activate = os.path.join(os.path.dirname(__file__), 'venv/bin/activate_this.py')
-if os.path.exists(venv_activate):
+# Activate virtual environment if it exists (VENV_ACTIVATE overrides the location).
+# Opening directly instead of checking os.path.exists first saves a stat per worker boot.
+venv_activate = os.environ.get('VENV_ACTIVATE') or os.path.join(os.path.dirname(__file__), 'venv/bin/activate_this.py')
+try:
     with open(venv_activate) as f:
         exec(f.read(), {'__file__': venv_activate})
+except FileNotFoundError:
+    pass
 
-# Load environment variables from .env (optional in production)
+# Load environment variables from .env (optional in production; DOTENV_PATH overrides the location)
 try:
     from dotenv import load_dotenv
-    env_path = os.path.join(os.path.dirname(__file__), '.env')
-    if os.path.exists(env_path):
-        load_dotenv(env_path)
+    # A missing file is simply skipped by load_dotenv
+    load_dotenv(os.environ.get('DOTENV_PATH') or os.path.join(os.path.dirname(__file__), '.env'))
 except ImportError:
     # python-dotenv not installed, use environment variables directly
     pass
 
-# Import Flask application
+# Import Flask application (importing app also creates missing tables unless SKIP_DB_INIT=1)
 try:
     from app import app as application
     print("✅ Flask app imported successfully")
@@ -30,16 +32,6 @@ except Exception as e:
     traceback.print_exc()
     raise
 
-# Create tables on startup - wrapped in try/except to not block startup
-try:
-    with application.app_context():
-        from models import db
-        db.create_all()
-        print("✅ Database tables created/verified")
-except Exception as e:
-    print(f"⚠️ Database setup warning (app will still run): {e}")
-    # Don't crash - let the app start even if DB has issues
-
 # WSGI entry point for LiteSpeed
 if __name__ == '__main__':
     application.run()